@@ -2,6 +2,8 @@ import requests
 import uuid
 from dynamic_form import JsonFlaskParser
 
+from metadata_registration_lib.http_utils import ACCEPT_ENCODING_HEADER, iter_json_array
+
 PRIMITIVES = (bool, int, float, str)
 PRIMITIVES_LIST = (*PRIMITIVES, list)
 
@@ -23,7 +25,7 @@ def login_and_get_header(login_url, use_token=True, email=None, password=None):
     return header
 
 
-def map_key_value(url, key="id", value="name", mask=None):
+def map_key_value(url, key="id", value="name", mask=None, stream=False, scheduler=None):
     """Call API at url endpoint and create a dict which maps key to value
 
     If the response contains identical keys, only the last value is stored for this key. The mapping only works
@@ -37,24 +39,29 @@ def map_key_value(url, key="id", value="name", mask=None):
     :type value: str
     :param mask: Mask string to be used in the x-Fields header of the request
     :type mask: str
+    :param stream: Parse the response items incrementally instead of loading the whole response
+    :type stream: bool
+    :param scheduler: Optional http_utils.RequestScheduler used to send the request
+    :type scheduler: RequestScheduler
     ...
     :return: A dict with maps key -> value
     :rtype: dict
 
     """
     if mask is None:
-        headers = {"x-Fields": f"{key}, {value}"}
+        headers = {"x-Fields": f"{key}, {value}", **ACCEPT_ENCODING_HEADER}
     else:
-        headers = {"x-Fields": mask}
-
-    res = requests.get(url, headers=headers)
+        headers = {"x-Fields": mask, **ACCEPT_ENCODING_HEADER}
 
-    if res.status_code != 200:
-        raise Exception(
-            f"Request to {url} failed with key: {key} and value: {value}. {res.json()}"
-        )
+    send = scheduler.request if scheduler is not None else requests.request
+    with send("get", url, headers=headers, stream=stream) as res:
+        if res.status_code != 200:
+            raise Exception(
+                f"Request to {url} failed with key: {key} and value: {value}. {res.json()}"
+            )
 
-    return {entry[key]: entry[value] for entry in res.json()}
+        entries = iter_json_array(res) if stream else res.json()
+        return {entry[key]: entry[value] for entry in entries}
 
 
 def map_key_value_from_dict_list(dict_list, key, value=None):
@@ -91,21 +98,24 @@ def get_prop_name_to_cv_name(property_url):
     return prop_name_to_cv_name
 
 
-def get_entity_by_name(name, endpoint):
-    header = {"X-Fields": "name, id"}
-    res = requests.get(endpoint, headers=header)
-
-    if res.status_code != 200:
-        raise Exception(f"Fail to load all entities [{res.status_code}] {res.json()}")
+def get_entity_by_name(name, endpoint, stream=False):
+    header = {"X-Fields": "name, id", **ACCEPT_ENCODING_HEADER}
+    with requests.get(endpoint, headers=header, stream=stream) as res:
+        if res.status_code != 200:
+            raise Exception(
+                f"Fail to load all entities [{res.status_code}] {res.json()}"
+            )
 
-    try:
-        entity_entry = next(filter(lambda entry: entry["name"] == name, res.json()))
-        entity_json = requests.get(f"{endpoint}/id/{entity_entry['id']}").json()
-        return entity_json
+        # When streaming, stops reading the response at the first match
+        entries = iter_json_array(res) if stream else res.json()
+        entity_entry = next(filter(lambda entry: entry["name"] == name, entries), None)
 
-    except StopIteration:
+    if entity_entry is None:
         raise Exception(f"Fail to find entity in database (name:{name})")
 
+    entity_json = requests.get(f"{endpoint}/id/{entity_entry['id']}").json()
+    return entity_json
+
 
 def get_form_by_name(name, form_endpoint):
     form_json = get_entity_by_name(name, form_endpoint)
@@ -1,7 +1,20 @@
+import hashlib
 import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import requests
 
-from metadata_registration_lib.api_utils import map_key_value, get_prop_name_to_cv_name
+from metadata_registration_lib.api_utils import (
+    map_key_value,
+    get_prop_name_to_cv_name,
+    get_entity_by_name,
+)
+from metadata_registration_lib.http_utils import encode_json_body
+from metadata_registration_lib.study_upload import fetch_studies
 
 
 def get_nb_pages(nb_hits, es_size):
@@ -27,6 +40,18 @@ def get_es_index_url(es_config):
         raise Exception("ES server not properly configured")
 
 
+def get_es_host_url(es_config):
+    """
+    Returns the URL of the Elastic Search server (without index)
+    Parameters:
+        - es_config (dict): configuration dict
+    """
+    if all([es_config[x] is not None for x in ["HOST", "PORT"]]):
+        return f"{es_config['HOST']}:{es_config['PORT']}"
+    else:
+        raise Exception("ES server not properly configured")
+
+
 def get_es_auth(es_config):
     """
     Returns an auth tuple (username, psw) if the Elastic Search server is set to "secure" else returns None
@@ -39,12 +64,13 @@ def get_es_auth(es_config):
         return None
 
 
-def index_study(es_index_url, es_auth, study_data, action, endpoints):
-    """Index or update a study on the ES server"""
-    headers = {"Content-type": "application/json"}
-    study_id = study_data["id"]
-
-    # Move "entries" and "meta_information" properties to the root
+def prepare_study_for_indexing(study_data, cv_tables):
+    """
+    Returns the document to index for a study (API format with "entries" in form format)
+        - "entries" and "meta_information" properties are moved to the root
+        - CV values are replaced by expended items (name, label and synonyms)
+    cv_tables: see get_cv_tables, the CV expansion plan is used if present
+    """
     for entry_prop, entry_value in study_data["entries"].items():
         study_data[entry_prop] = entry_value
     del study_data["entries"]
@@ -53,22 +79,214 @@ def index_study(es_index_url, es_auth, study_data, action, endpoints):
         study_data[entry_prop] = entry_value
     del study_data["meta_information"]
 
-    # Replace properties CV values by expended items
-    cv_items_expended = get_cv_items_expended_for_indexing(endpoints["cv"])
-    prop_name_to_cv_name = get_prop_name_to_cv_name(endpoints["prop"])
-    study_data = expend_cv_values(study_data, cv_items_expended, prop_name_to_cv_name)
+    return expend_cv_values_from_tables(study_data, cv_tables)
+
+
+def get_doc_diff(previous_doc, new_doc):
+    """
+    Returns the partial document to send to the _update endpoint to go from
+    previous_doc to new_doc
+        - Changed or added fields are included (recursively for objects)
+        - Removed fields are not included (see get_removed_key_paths)
+        - Lists are replaced as a whole
+    """
+    diff = {}
+    for key, value in new_doc.items():
+        previous_value = previous_doc.get(key)
+        if key not in previous_doc:
+            diff[key] = value
+        elif type(value) == dict and type(previous_value) == dict:
+            nested_diff = get_doc_diff(previous_value, value)
+            if len(nested_diff) > 0:
+                diff[key] = nested_diff
+        elif previous_value != value:
+            diff[key] = value
+
+    return diff
+
+
+def get_removed_key_paths(previous_doc, new_doc):
+    """
+    Returns the key paths (lists of keys) of the fields of previous_doc that are not
+    in new_doc, recursively for objects present in both documents
+    """
+    removed_key_paths = []
+    for key, previous_value in previous_doc.items():
+        if key not in new_doc:
+            removed_key_paths.append([key])
+        elif type(previous_value) == dict and type(new_doc[key]) == dict:
+            for path in get_removed_key_paths(previous_value, new_doc[key]):
+                removed_key_paths.append([key] + path)
+
+    return removed_key_paths
+
+
+# Painless script merging params.doc into the document (like a "doc" partial update)
+# and removing the fields at params.removed key paths
+PARTIAL_UPDATE_SCRIPT = """
+void merge(Map target, Map changes) {
+    for (entry in changes.entrySet()) {
+        def value = entry.getValue();
+        def current = target.get(entry.getKey());
+        if (value instanceof Map && current instanceof Map) {
+            merge(current, value);
+        } else {
+            target.put(entry.getKey(), value);
+        }
+    }
+}
+merge(ctx._source, params.doc);
+for (path in params.removed) {
+    def node = ctx._source;
+    for (int i = 0; i < path.size() - 1 && node instanceof Map; i++) {
+        node = node.get(path.get(i));
+    }
+    if (node instanceof Map) {
+        node.remove(path.get(path.size() - 1));
+    }
+}
+"""
+
+
+def get_partial_update_body(diff, removed_key_paths=None):
+    """
+    Returns the body of an _update request applying a diff (see get_doc_diff)
+    A scripted update is used when fields have to be removed, so that the result
+    matches a full update of the document
+    """
+    if not removed_key_paths:
+        return {"doc": diff}
+
+    return {
+        "script": {
+            "source": PARTIAL_UPDATE_SCRIPT,
+            "lang": "painless",
+            "params": {"doc": diff, "removed": removed_key_paths},
+        }
+    }
+
+
+def get_indexed_study(es_index_url, es_auth, study_id):
+    """Returns the indexed document (_source) of a study"""
+    res = requests.get(url=f"{es_index_url}/_doc/{study_id}", auth=es_auth)
+    if res.status_code != 200 or not res.json().get("found", False):
+        raise Exception(f"Study {study_id} not found in index: {res.json()}")
+
+    return res.json()["_source"]
+
+
+# Content hash related code (skip unchanged studies)
+def get_doc_hash(doc):
+    """Returns a stable content hash of a document (independent of the keys order)"""
+    doc_str = json.dumps(doc, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(doc_str.encode("utf-8")).hexdigest()
+
+
+def write_json_file(path, data):
+    """Write JSON data to a file atomically (temporary file + rename)"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def load_index_manifest(manifest_path):
+    """
+    Returns the index manifest (dict study_id -> hash of the indexed document)
+    Returns an empty manifest if the file does not exist yet
+    """
+    if not os.path.exists(manifest_path):
+        return {}
+
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def save_index_manifest(manifest_path, manifest):
+    write_json_file(manifest_path, manifest)
+
+
+def index_study(
+    es_index_url,
+    es_auth,
+    study_data,
+    action,
+    endpoints,
+    compress=None,
+    cv_tables=None,
+    previous_doc=None,
+    diff=None,
+    manifest=None,
+):
+    """
+    Index or update a study on the ES server
+    action:
+        - "add": create the document
+        - "update": replace the whole document
+        - "partial_update": only send the changed fields (_update endpoint), computed
+            against previous_doc (fetched from the index if not given), or the given diff
+            (changed properties in form format, at the root of the indexed document).
+            Removed fields are deleted with a scripted update (not possible with a given diff)
+    "compress" ("gzip" or "deflate") enables compression of large documents
+    "cv_tables" (see get_cv_tables) defaults to the cached tables of endpoints
+    "manifest" (see load_index_manifest): the write is skipped if the content hash of
+        the document matches the manifest, which is updated after successful writes
+        (with a caller-supplied diff, the study is removed from the manifest instead)
+    """
+    study_id = study_data["id"]
+    doc_hash = None
+
+    if cv_tables is None:
+        cv_tables = get_cv_tables(endpoints)
+
+    if action == "partial_update" and diff is not None:
+        study_data = {"doc": expend_cv_values_from_tables(diff, cv_tables)}
+    else:
+        doc = prepare_study_for_indexing(study_data, cv_tables)
+
+        if manifest is not None:
+            doc_hash = get_doc_hash(doc)
+            if manifest.get(study_id) == doc_hash:
+                return {"_id": study_id, "result": "noop"}
+
+        if action == "partial_update":
+            if previous_doc is None:
+                previous_doc = get_indexed_study(es_index_url, es_auth, study_id)
+            diff = get_doc_diff(previous_doc, doc)
+            removed_key_paths = get_removed_key_paths(previous_doc, doc)
+
+            if len(diff) == 0 and len(removed_key_paths) == 0:
+                if doc_hash is not None:
+                    manifest[study_id] = doc_hash
+                return {"_id": study_id, "result": "noop"}
+
+            study_data = get_partial_update_body(diff, removed_key_paths)
+        else:
+            study_data = doc
+
+    if action == "partial_update" and study_data.get("doc") == {}:
+        return {"_id": study_id, "result": "noop"}
+
+    body, headers = encode_json_body(study_data, compress=compress)
 
     if action == "add":
         res = requests.post(
             url=f"{es_index_url}/_create/{study_id}",
-            data=json.dumps(study_data),
+            data=body,
             headers=headers,
             auth=es_auth,
         )
     elif action == "update":
         res = requests.put(
             url=f"{es_index_url}/_doc/{study_id}",
-            data=json.dumps(study_data),
+            data=body,
+            headers=headers,
+            auth=es_auth,
+        )
+    elif action == "partial_update":
+        res = requests.post(
+            url=f"{es_index_url}/_update/{study_id}",
+            data=body,
             headers=headers,
             auth=es_auth,
         )
@@ -76,10 +294,16 @@ def index_study(es_index_url, es_auth, study_data, action, endpoints):
     if "error" in res.json().keys():
         raise Exception(f"Error while indexing the study: {res.json()}")
 
+    if doc_hash is not None:
+        manifest[study_id] = doc_hash
+    elif manifest is not None:
+        # Caller-supplied diff: the full document (and its hash) is unknown
+        manifest.pop(study_id, None)
+
     return res.json()
 
 
-def remove_study_from_index(es_index_url, es_auth, study_id):
+def remove_study_from_index(es_index_url, es_auth, study_id, manifest=None):
     res = requests.delete(
         url=f"{es_index_url}/_doc/{study_id}",
         auth=es_auth,
@@ -87,61 +311,817 @@ def remove_study_from_index(es_index_url, es_auth, study_id):
     if "error" in res.json().keys():
         raise Exception(f"Error while deleting study from index: {res.json()}")
 
+    if manifest is not None:
+        manifest.pop(study_id, None)
+
     return res.json()
 
 
+# Bulk related code
+BULK_ACTIONS = {"add": "create", "update": "index", "delete": "delete"}
+
+
+def get_bulk_lines(doc_id, action, doc=None):
+    """Returns the NDJSON lines (bytes) of one document for the _bulk endpoint"""
+    lines = json.dumps({BULK_ACTIONS[action]: {"_id": doc_id}}) + "\n"
+    if doc is not None:
+        lines += json.dumps(doc) + "\n"
+    return lines.encode("utf-8")
+
+
+def iter_bulk_chunks(bulk_lines, max_chunk_size=5 * 1024 * 1024, max_chunk_docs=500):
+    """
+    Group NDJSON lines into request bodies bounded in size (bytes) and number of documents
+    Parameters:
+        - bulk_lines: iterable of bytes (see get_bulk_lines), one element per document
+    Yields:
+        - body (bytes): NDJSON body for the _bulk endpoint
+    """
+    chunk = []
+    chunk_size = 0
+    for lines in bulk_lines:
+        if chunk and (
+            chunk_size + len(lines) > max_chunk_size or len(chunk) >= max_chunk_docs
+        ):
+            yield b"".join(chunk)
+            chunk = []
+            chunk_size = 0
+        chunk.append(lines)
+        chunk_size += len(lines)
+
+    if chunk:
+        yield b"".join(chunk)
+
+
+def send_bulk_request(es_index_url, es_auth, body):
+    """
+    Send a NDJSON body to the _bulk endpoint
+    Returns:
+        - nb_success (int)
+        - errors (list of dict): {"id": xxx, "status": xxx, "error": xxx} one per failed item
+    """
+    res = requests.post(
+        url=f"{es_index_url}/_bulk",
+        data=body,
+        headers={"Content-type": "application/x-ndjson"},
+        auth=es_auth,
+    )
+    res_json = res.json()
+    if "items" not in res_json:
+        raise Exception(f"Error while sending bulk request: {res_json}")
+
+    nb_success = 0
+    errors = []
+    for item in res_json["items"]:
+        item_result = next(iter(item.values()))
+        if "error" in item_result:
+            errors.append(
+                {
+                    "id": item_result["_id"],
+                    "status": item_result["status"],
+                    "error": item_result["error"],
+                }
+            )
+        else:
+            nb_success += 1
+
+    return nb_success, errors
+
+
+def send_bulk_lines(es_index_url, es_auth, bulk_lines, **chunk_kwargs):
+    """Send NDJSON lines to the _bulk endpoint in bounded chunks and aggregate the results"""
+    results = {"nb_success": 0, "errors": []}
+    for body in iter_bulk_chunks(bulk_lines, **chunk_kwargs):
+        nb_success, errors = send_bulk_request(es_index_url, es_auth, body)
+        results["nb_success"] += nb_success
+        results["errors"].extend(errors)
+
+    return results
+
+
+def bulk_index_studies(
+    es_index_url,
+    es_auth,
+    studies,
+    action,
+    endpoints,
+    cv_tables=None,
+    manifest=None,
+    processes=None,
+    **chunk_kwargs,
+):
+    """
+    Index or update many studies on the ES server using the _bulk endpoint
+    Parameters:
+        - studies: iterable of studies (same format as for index_study)
+        - action: "add" or "update"
+        - cv_tables: see get_cv_tables, defaults to the cached tables of endpoints
+        - manifest: see load_index_manifest, studies whose document hash matches the
+            manifest are skipped and the manifest is updated for successful writes
+        - processes: if given, documents are prepared in a pool of processes
+            (see iter_prepared_studies)
+        - chunk_kwargs: max_chunk_size and max_chunk_docs (see iter_bulk_chunks)
+    Returns:
+        - results (dict): {"nb_success": xxx, "nb_skipped": xxx,
+            "errors": [{"id", "status", "error"}, ...]}
+    """
+    if cv_tables is None:
+        cv_tables = get_cv_tables(endpoints)
+
+    nb_skipped = 0
+    id_to_new_hash = {}
+
+    def get_studies_bulk_lines(docs):
+        nonlocal nb_skipped
+        for doc in docs:
+            if manifest is not None:
+                doc_hash = get_doc_hash(doc)
+                if manifest.get(doc["id"]) == doc_hash:
+                    nb_skipped += 1
+                    continue
+                id_to_new_hash[doc["id"]] = doc_hash
+
+            yield get_bulk_lines(doc["id"], action, doc)
+
+    if processes is None:
+        docs = (prepare_study_for_indexing(study, cv_tables) for study in studies)
+        results = send_bulk_lines(
+            es_index_url, es_auth, get_studies_bulk_lines(docs), **chunk_kwargs
+        )
+    else:
+        with get_indexing_pool(cv_tables, processes) as executor:
+            docs = iter_prepared_studies(studies, executor)
+            results = send_bulk_lines(
+                es_index_url, es_auth, get_studies_bulk_lines(docs), **chunk_kwargs
+            )
+
+    if manifest is not None:
+        failed_ids = {error["id"] for error in results["errors"]}
+        for study_id, doc_hash in id_to_new_hash.items():
+            if study_id not in failed_ids:
+                manifest[study_id] = doc_hash
+
+    results["nb_skipped"] = nb_skipped
+    return results
+
+
+def bulk_remove_studies(
+    es_index_url, es_auth, study_ids, manifest=None, **chunk_kwargs
+):
+    """
+    Remove many studies from the index using the _bulk endpoint
+    The removed studies are also removed from the manifest (see load_index_manifest)
+    Returns:
+        - results (dict): {"nb_success": xxx, "errors": [{"id", "status", "error"}, ...]}
+    """
+    study_ids = list(study_ids)
+    bulk_lines = (get_bulk_lines(study_id, "delete") for study_id in study_ids)
+    results = send_bulk_lines(es_index_url, es_auth, bulk_lines, **chunk_kwargs)
+
+    if manifest is not None:
+        failed_ids = {error["id"] for error in results["errors"]}
+        for study_id in study_ids:
+            if study_id not in failed_ids:
+                manifest.pop(study_id, None)
+
+    return results
+
+
+# Process pool related code (CPU bound preparation of the documents)
+worker_cv_tables = None
+
+
+def init_indexing_worker(cv_tables):
+    """Store the CV tables once per worker process instead of sending them with each task"""
+    global worker_cv_tables
+    worker_cv_tables = cv_tables
+
+
+def prepare_studies_in_worker(studies):
+    return [prepare_study_for_indexing(study, worker_cv_tables) for study in studies]
+
+
+def get_indexing_pool(cv_tables, processes=None):
+    """Returns a process pool whose workers hold the CV tables (see get_cv_tables)"""
+    return ProcessPoolExecutor(
+        max_workers=processes,
+        initializer=init_indexing_worker,
+        initargs=(cv_tables,),
+    )
+
+
+def iter_prepared_studies(studies, executor, batch_size=20, max_pending_batches=None):
+    """
+    Generator preparing studies for indexing (see prepare_study_for_indexing) in a pool
+    of processes (see get_indexing_pool) and yielding the documents in the same order
+    Studies are sent to the workers by batches of batch_size and at most
+    max_pending_batches batches (default: 2 per CPU) are processed at the same time,
+    so that studies can be streamed without being all loaded in memory.
+    """
+    if max_pending_batches is None:
+        max_pending_batches = 2 * (os.cpu_count() or 1)
+
+    pending = deque()
+    batch = []
+    for study in studies:
+        batch.append(study)
+        if len(batch) == batch_size:
+            pending.append(executor.submit(prepare_studies_in_worker, batch))
+            batch = []
+            if len(pending) >= max_pending_batches:
+                yield from pending.popleft().result()
+
+    if len(batch) > 0:
+        pending.append(executor.submit(prepare_studies_in_worker, batch))
+
+    while pending:
+        yield from pending.popleft().result()
+
+
+# Full reindex related code
+def load_reindex_checkpoint(checkpoint_path):
+    if checkpoint_path is None or not os.path.exists(checkpoint_path):
+        return {"last_id": None, "nb_success": 0, "nb_errors": 0}
+
+    with open(checkpoint_path, "r") as f:
+        return json.load(f)
+
+
+def save_reindex_checkpoint(checkpoint_path, checkpoint):
+    write_json_file(checkpoint_path, checkpoint)
+
+
+def reindex_studies(
+    es_index_url,
+    es_auth,
+    endpoints,
+    page_size=200,
+    processes=None,
+    fetch_concurrency=8,
+    checkpoint_path=None,
+    cv_tables=None,
+    headers=None,
+    **chunk_kwargs,
+):
+    """
+    Reindex all the studies of the registration API using the _bulk endpoint
+    Studies ids are sorted and processed by pages of page_size studies:
+        1. Studies are fetched in parallel (fetch_studies, entries in form format)
+        2. Documents are prepared (flattening + CV expansion) in a process pool
+        3. Documents are sent to the _bulk endpoint (index action)
+    Progress and throughput are printed after each page. If checkpoint_path is given,
+    the last processed study id is saved after each page so that a failed run can be
+    resumed by calling the function again with the same checkpoint_path (only ids
+    after it are processed, studies created or deleted in between do not shift pages).
+    Parameters:
+        - endpoints (dict): "study", "cv" and "prop" URLs
+        - processes (int): number of processes preparing the documents (default: nb CPUs)
+        - fetch_concurrency (int): number of studies fetched in parallel
+        - headers (dict): headers for the API requests (ex: access token)
+        - chunk_kwargs: max_chunk_size and max_chunk_docs (see iter_bulk_chunks)
+    Returns:
+        - results (dict): {"nb_success": xxx, "nb_errors": xxx, "errors": [...]}
+            errors are only the ones of the current run
+    """
+    if cv_tables is None:
+        cv_tables = get_cv_tables(endpoints)
+
+    study_ids = sorted(
+        map_key_value(endpoints["study"], key="id", value="id", mask="id").keys()
+    )
+
+    checkpoint = load_reindex_checkpoint(checkpoint_path)
+    if checkpoint["last_id"] is not None:
+        print(f"Resuming reindex after study {checkpoint['last_id']}")
+        study_ids = [id for id in study_ids if id > checkpoint["last_id"]]
+    nb_pages = get_nb_pages(len(study_ids), page_size)
+
+    errors = []
+    start_time = time.monotonic()
+    nb_processed = 0
+
+    with get_indexing_pool(cv_tables, processes) as executor:
+        for page in range(nb_pages):
+            page_ids = study_ids[page * page_size : (page + 1) * page_size]
+            studies = (
+                study
+                for _, study in fetch_studies(
+                    page_ids,
+                    endpoints["study"],
+                    concurrency=fetch_concurrency,
+                    headers=headers,
+                    params={"entry_format": "form"},
+                )
+            )
+
+            docs = iter_prepared_studies(studies, executor)
+            bulk_lines = (get_bulk_lines(doc["id"], "update", doc) for doc in docs)
+            results = send_bulk_lines(es_index_url, es_auth, bulk_lines, **chunk_kwargs)
+
+            errors.extend(results["errors"])
+            nb_processed += len(page_ids)
+            checkpoint["last_id"] = page_ids[-1]
+            checkpoint["nb_success"] += results["nb_success"]
+            checkpoint["nb_errors"] += len(results["errors"])
+            if checkpoint_path is not None:
+                save_reindex_checkpoint(checkpoint_path, checkpoint)
+
+            throughput = nb_processed / (time.monotonic() - start_time)
+            print(
+                f"Page {page + 1}/{nb_pages}: {checkpoint['nb_success']} studies indexed, "
+                f"{checkpoint['nb_errors']} errors ({throughput:.1f} studies/s)"
+            )
+
+    # The run is complete, the next one starts from scratch
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    return {
+        "nb_success": checkpoint["nb_success"],
+        "nb_errors": checkpoint["nb_errors"],
+        "errors": errors,
+    }
+
+
+# Zero-downtime reindex related code
+def send_es_request(method, url, es_auth, json_data=None):
+    """Send a request to the ES server and returns the JSON response, raises on error"""
+    res = requests.request(method, url=url, json=json_data, auth=es_auth)
+    res_json = res.json()
+    if isinstance(res_json, dict) and "error" in res_json:
+        raise Exception(f"Error on ES request {method.upper()} {url}: {res_json}")
+    return res_json
+
+
+def get_alias_indices(es_host_url, es_auth, alias):
+    """
+    Returns the indices currently used by the alias
+        - indices (list): index names (possibly empty)
+        - is_concrete_index (bool): True if "alias" is actually an index name
+    """
+    res = requests.get(url=f"{es_host_url}/_alias/{alias}", auth=es_auth)
+    if res.status_code == 200:
+        return list(res.json().keys()), False
+
+    res = requests.head(url=f"{es_host_url}/{alias}", auth=es_auth)
+    if res.status_code == 200:
+        return [alias], True
+
+    return [], False
+
+
+def reindex_studies_with_alias(
+    es_config, endpoints, new_index=None, keep_old_indices=False, **reindex_kwargs
+):
+    """
+    Reindex all the studies in a new versioned index and swap the alias es_config["INDEX"]
+    The live index is untouched until the atomic swap:
+        1. A new index "<alias>_<timestamp>" is created with the mappings, analysis and
+            number of shards of the live index, refresh disabled and no replicas during the load
+        2. Studies are indexed with reindex_studies
+        3. Refresh interval and number of replicas of the live index are restored and the
+            index is refreshed
+        4. The alias is moved to the new index in one atomic _aliases request
+        5. Old indices are deleted (unless keep_old_indices is True)
+    If es_config["INDEX"] is a concrete index (no alias yet), it is replaced by the alias.
+    Parameters:
+        - new_index (str): name of an index created by a previous failed run to resume
+            (use the same checkpoint_path in reindex_kwargs)
+        - reindex_kwargs: see reindex_studies
+    Returns:
+        - results (dict): see reindex_studies, with the "index" name
+    """
+    es_host_url = get_es_host_url(es_config)
+    es_auth = get_es_auth(es_config)
+    alias = es_config["INDEX"]
+
+    old_indices, is_concrete_index = get_alias_indices(es_host_url, es_auth, alias)
+
+    if new_index is not None:
+        old_indices = [index for index in old_indices if index != new_index]
+
+    # Settings of the live index to carry over (defaults of ES if there is none)
+    live_settings = {}
+    if len(old_indices) > 0:
+        old_settings = send_es_request(
+            "get", f"{es_host_url}/{old_indices[0]}/_settings", es_auth
+        )
+        live_settings = next(iter(old_settings.values()))["settings"]["index"]
+    live_replicas = int(live_settings.get("number_of_replicas", 1))
+    live_refresh_interval = live_settings.get("refresh_interval")
+
+    if new_index is None:
+        new_index = f"{alias}_{time.strftime('%Y%m%d%H%M%S')}"
+        index_settings = {"refresh_interval": "-1", "number_of_replicas": 0}
+        for setting in ["number_of_shards", "analysis"]:
+            if setting in live_settings:
+                index_settings[setting] = live_settings[setting]
+        index_body = {"settings": {"index": index_settings}}
+
+        if len(old_indices) > 0:
+            old_mappings = send_es_request(
+                "get", f"{es_host_url}/{old_indices[0]}/_mapping", es_auth
+            )
+            index_body["mappings"] = next(iter(old_mappings.values()))["mappings"]
+
+        send_es_request("put", f"{es_host_url}/{new_index}", es_auth, index_body)
+        print(f"Created index {new_index} (alias: {alias})")
+
+    results = reindex_studies(
+        f"{es_host_url}/{new_index}", es_auth, endpoints, **reindex_kwargs
+    )
+
+    # Restore live settings
+    send_es_request(
+        "put",
+        f"{es_host_url}/{new_index}/_settings",
+        es_auth,
+        {
+            "index": {
+                "refresh_interval": live_refresh_interval,
+                "number_of_replicas": live_replicas,
+            }
+        },
+    )
+    send_es_request("post", f"{es_host_url}/{new_index}/_refresh", es_auth)
+
+    # Atomic swap
+    actions = [{"add": {"index": new_index, "alias": alias}}]
+    if is_concrete_index:
+        actions.append({"remove_index": {"index": alias}})
+    else:
+        for old_index in old_indices:
+            actions.append({"remove": {"index": old_index, "alias": alias}})
+    send_es_request("post", f"{es_host_url}/_aliases", es_auth, {"actions": actions})
+    print(f"Alias {alias} now points to {new_index}")
+
+    if not keep_old_indices and not is_concrete_index:
+        for old_index in old_indices:
+            send_es_request("delete", f"{es_host_url}/{old_index}", es_auth)
+
+    results["index"] = new_index
+    return results
+
+
+# Search related code
+def iter_search_hits(
+    es_index_url, es_auth, query=None, page_size=1000, source=None, keep_alive="1m"
+):
+    """
+    Generator streaming all the hits of a query, in constant memory
+    Uses search_after with a point in time (PIT), or scroll if PIT is not supported
+    by the server. Unlike from/size pagination, it is not capped at 10k hits.
+    Parameters:
+        - query (dict): ES query, defaults to match_all
+        - page_size (int): number of hits per request
+        - source: _source filtering (ex: ["id", "title"] or False)
+        - keep_alive (str): time the PIT / scroll context is kept between requests
+    """
+    query = query if query is not None else {"match_all": {}}
+    es_host_url = es_index_url.rsplit("/", 1)[0]
+
+    res = requests.post(
+        url=f"{es_index_url}/_pit", params={"keep_alive": keep_alive}, auth=es_auth
+    )
+    if res.status_code == 200 and "id" in res.json():
+        yield from iter_search_hits_with_pit(
+            es_host_url, es_auth, res.json()["id"], query, page_size, source, keep_alive
+        )
+    else:
+        yield from iter_search_hits_with_scroll(
+            es_index_url, es_auth, query, page_size, source, keep_alive
+        )
+
+
+def iter_search_hits_with_pit(
+    es_host_url, es_auth, pit_id, query, page_size, source, keep_alive
+):
+    search_body = {
+        "size": page_size,
+        "query": query,
+        "sort": [{"_shard_doc": "asc"}],
+    }
+    if source is not None:
+        search_body["_source"] = source
+
+    try:
+        while True:
+            search_body["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+            res_json = send_es_request(
+                "post", f"{es_host_url}/_search", es_auth, search_body
+            )
+            # The PIT id can change between requests
+            pit_id = res_json.get("pit_id", pit_id)
+
+            hits = res_json["hits"]["hits"]
+            yield from hits
+            if len(hits) < page_size:
+                break
+            search_body["search_after"] = hits[-1]["sort"]
+    finally:
+        requests.delete(url=f"{es_host_url}/_pit", json={"id": pit_id}, auth=es_auth)
+
+
+def iter_search_hits_with_scroll(
+    es_index_url, es_auth, query, page_size, source, keep_alive
+):
+    es_host_url = es_index_url.rsplit("/", 1)[0]
+    search_body = {"size": page_size, "query": query, "sort": ["_doc"]}
+    if source is not None:
+        search_body["_source"] = source
+
+    res_json = send_es_request(
+        "post", f"{es_index_url}/_search?scroll={keep_alive}", es_auth, search_body
+    )
+    scroll_id = res_json["_scroll_id"]
+    try:
+        while True:
+            hits = res_json["hits"]["hits"]
+            yield from hits
+            if len(hits) < page_size:
+                break
+            res_json = send_es_request(
+                "post",
+                f"{es_host_url}/_search/scroll",
+                es_auth,
+                {"scroll": keep_alive, "scroll_id": scroll_id},
+            )
+            scroll_id = res_json.get("_scroll_id", scroll_id)
+    finally:
+        requests.delete(
+            url=f"{es_host_url}/_search/scroll",
+            json={"scroll_id": scroll_id},
+            auth=es_auth,
+        )
+
+
 # CV related code to add labels and item synonyms to the index
-def get_cv_items_expended_for_indexing(cv_url):
+CV_TABLES_TTL = 600  # seconds
+
+cv_tables_cache = {}
+cv_tables_lock = threading.Lock()
+
+
+def get_cv_tables(
+    endpoints, ttl=CV_TABLES_TTL, force_refresh=False, expansion_plan_forms=None
+):
+    """
+    Returns the tables needed to expand CV values, cached for ttl seconds
+    The cache is shared by all index_study / bulk_index_studies calls using the same endpoints.
+    Parameters:
+        - endpoints (dict): must contain "cv" and "prop" URLs ("form" for the expansion plan)
+        - ttl (int): time (seconds) after which the tables are downloaded again
+        - force_refresh (bool): ignore cached tables
+        - expansion_plan_forms (dict): key path -> list of form names used to compile
+            the CV expansion plan (see get_cv_expansion_plan), ex: {"": ["study"]}
+    Returns:
+        - cv_tables (dict): {"cv_items_expended": xxx, "cv_synonym_index": xxx,
+            "prop_name_to_cv_name": xxx, "cv_expansion_plan": xxx}
+    """
+    plan_key = (
+        json.dumps(expansion_plan_forms, sort_keys=True)
+        if expansion_plan_forms is not None
+        else None
+    )
+    cache_key = (endpoints["cv"], endpoints["prop"], plan_key)
+    with cv_tables_lock:
+        cached = cv_tables_cache.get(cache_key)
+        if (
+            cached is not None
+            and not force_refresh
+            and time.monotonic() - cached["created"] < ttl
+        ):
+            return cached["tables"]
+
+        cv_items_expended, cv_synonym_index = get_cv_items_expended_for_indexing(
+            endpoints["cv"], return_synonym_index=True
+        )
+        prop_name_to_cv_name = get_prop_name_to_cv_name(endpoints["prop"])
+
+        cv_expansion_plan = None
+        if expansion_plan_forms is not None:
+            form_jsons_by_path = {
+                path: [get_entity_by_name(name, endpoints["form"]) for name in names]
+                for path, names in expansion_plan_forms.items()
+            }
+            cv_expansion_plan = get_cv_expansion_plan(
+                form_jsons_by_path, prop_name_to_cv_name
+            )
+
+        cv_tables = {
+            "cv_items_expended": cv_items_expended,
+            "cv_synonym_index": cv_synonym_index,
+            "prop_name_to_cv_name": prop_name_to_cv_name,
+            "cv_expansion_plan": cv_expansion_plan,
+        }
+        cv_tables_cache[cache_key] = {"tables": cv_tables, "created": time.monotonic()}
+        return cv_tables
+
+
+def invalidate_cv_tables(endpoints=None):
+    """Remove the cached CV tables of endpoints (all cached tables by default)"""
+    with cv_tables_lock:
+        if endpoints is None:
+            cv_tables_cache.clear()
+        else:
+            for cache_key in list(cv_tables_cache.keys()):
+                if cache_key[:2] == (endpoints["cv"], endpoints["prop"]):
+                    del cv_tables_cache[cache_key]
+
+
+def get_cv_items_expended_for_indexing(cv_url, return_synonym_index=False):
+    """
+    Returns a map cv_name -> item_name -> expended string ("name - label - synonyms")
+    If return_synonym_index is True, also returns a map cv_name -> term -> item_name
+    where term is an item name, label or synonym (exact match, first item wins).
+    """
     cv_name_to_items = map_key_value(cv_url, key="name", value="items")
 
     cv_items_map = {}
+    cv_synonym_index = {}
     for cv_name, cv_items in cv_name_to_items.items():
         cv_items_map[cv_name] = {}
+        cv_synonym_index[cv_name] = {item["name"]: item["name"] for item in cv_items}
         for item in cv_items:
             expended_str = f"{item['name']} - {item['label']}"
             if len(item["synonyms"]) > 0:
                 expended_str += " - " + " - ".join(item["synonyms"])
             cv_items_map[cv_name][item["name"]] = expended_str
 
+            for term in [item["label"], *item["synonyms"]]:
+                cv_synonym_index[cv_name].setdefault(term, item["name"])
+
+    if return_synonym_index:
+        return cv_items_map, cv_synonym_index
     return cv_items_map
 
 
-def expend_cv_values(study, cv_items_expended, prop_name_to_cv_name):
-    def get_expended_item(cv_items, value):
-        # If value is a CV item name
-        if value in cv_items.keys():
-            return cv_items[value]
-        # If value is a CV item synonym
-        else:
-            for item_name, item_expended in cv_items.items():
-                if value in item_expended:
-                    return cv_items[item_name]
-            raise Exception("Value not found in item names or synonyms")
+def expend_cv_values_from_tables(doc, cv_tables):
+    """Replace CV values of a document using cv_tables (see get_cv_tables)"""
+    if cv_tables.get("cv_expansion_plan") is not None:
+        return expend_cv_values_with_plan(
+            doc,
+            cv_tables["cv_expansion_plan"],
+            cv_tables["cv_items_expended"],
+            cv_tables.get("cv_synonym_index"),
+        )
+
+    return expend_cv_values(
+        doc,
+        cv_tables["cv_items_expended"],
+        cv_tables["prop_name_to_cv_name"],
+        cv_tables.get("cv_synonym_index"),
+    )
+
+
+def get_expended_item(cv_items, value, synonym_index=None):
+    # If value is a CV item name
+    if value in cv_items.keys():
+        return cv_items[value]
+    # If value is a CV item label or synonym
+    elif synonym_index is not None and value in synonym_index:
+        return cv_items[synonym_index[value]]
+    else:
+        for item_name, item_expended in cv_items.items():
+            if value in item_expended:
+                return cv_items[item_name]
+        raise Exception("Value not found in item names or synonyms")
+
+
+def get_expended_value(value, cv_items, synonym_index=None):
+    """Expend a CV value or a list of CV values (joined by " // ")"""
+    if type(value) == list:
+        return " // ".join(
+            [get_expended_item(cv_items, v, synonym_index) for v in value]
+        )
+    else:
+        return get_expended_item(cv_items, value, synonym_index)
+
+
+def expend_cv_values(
+    study, cv_items_expended, prop_name_to_cv_name, cv_synonym_index=None
+):
+    """
+    Replace CV values of a study (form format) by the expended items
+    cv_synonym_index (see get_cv_items_expended_for_indexing) resolves labels and
+    synonyms in O(1), values not found in it fall back to a substring search.
+    """
 
     for prop_name, value in study.items():
         if prop_name in prop_name_to_cv_name:
             cv_name = prop_name_to_cv_name[prop_name]
             cv_items = cv_items_expended[cv_name]
+            synonym_index = (
+                cv_synonym_index.get(cv_name) if cv_synonym_index is not None else None
+            )
             try:
-                if type(value) == list:
-                    study[prop_name] = " // ".join(
-                        [get_expended_item(cv_items, v) for v in value]
-                    )
-                else:
-                    study[prop_name] = get_expended_item(cv_items, value)
+                study[prop_name] = get_expended_value(value, cv_items, synonym_index)
             except Exception as e:
                 print(
                     f"\tFailed to expand {value} for property {prop_name} in study: {e}"
                 )
         elif type(value) == dict:
-            value = expend_cv_values(value, cv_items_expended, prop_name_to_cv_name)
+            value = expend_cv_values(
+                value, cv_items_expended, prop_name_to_cv_name, cv_synonym_index
+            )
         elif type(value) == list:
             for nested_value in value:
                 if type(nested_value) == dict:
                     nested_value = expend_cv_values(
-                        nested_value, cv_items_expended, prop_name_to_cv_name
+                        nested_value,
+                        cv_items_expended,
+                        prop_name_to_cv_name,
+                        cv_synonym_index,
                     )
                 elif prop_name in cv_items_expended:
                     nested_value = cv_items_expended[cv_name][nested_value]
 
     return study
+
+
+def get_cv_expansion_plan(form_jsons_by_path, prop_name_to_cv_name):
+    """
+    Compile the key paths where CV properties can occur in the indexed documents
+    Parameters:
+        - form_jsons_by_path (dict): key path ("" for the document root, "a.b" for nested
+            entities stored under a.b) -> list of form JSON (form registry)
+        - prop_name_to_cv_name (dict): see get_prop_name_to_cv_name
+    Returns:
+        - plan (dict): nested dict, prop_name -> cv_name for CV properties or
+            prop_name -> sub plan for nested forms (FormField and FieldList)
+    """
+
+    def merge_plans(plan, other_plan):
+        for key, value in other_plan.items():
+            if isinstance(value, dict) and isinstance(plan.get(key), dict):
+                merge_plans(plan[key], value)
+            else:
+                plan[key] = value
+        return plan
+
+    def compile_fields(fields):
+        plan = {}
+        for field in fields:
+            prop_name = field["property"]["name"]
+            if prop_name in prop_name_to_cv_name:
+                plan[prop_name] = prop_name_to_cv_name[prop_name]
+                continue
+
+            # FormField or FieldList of FormField
+            nested_fields = field.get("fields") or (field.get("args") or {}).get(
+                "object", {}
+            ).get("fields")
+            if nested_fields:
+                nested_plan = compile_fields(nested_fields)
+                if len(nested_plan) > 0:
+                    merge_plans(plan.setdefault(prop_name, {}), nested_plan)
+        return plan
+
+    plan = {}
+    for path, form_jsons in form_jsons_by_path.items():
+        node = plan
+        for key in [k for k in path.split(".") if k != ""]:
+            node = node.setdefault(key, {})
+        for form_json in form_jsons:
+            merge_plans(node, compile_fields(form_json["fields"]))
+
+    return plan
+
+
+def expend_cv_values_with_plan(study, plan, cv_items_expended, cv_synonym_index=None):
+    """
+    Replace CV values of a study by the expended items, only visiting the key paths
+    of the CV expansion plan (see get_cv_expansion_plan)
+    """
+    for prop_name, sub_plan in plan.items():
+        if prop_name not in study:
+            continue
+        value = study[prop_name]
+
+        # CV property
+        if isinstance(sub_plan, str):
+            synonym_index = (
+                cv_synonym_index.get(sub_plan) if cv_synonym_index is not None else None
+            )
+            try:
+                study[prop_name] = get_expended_value(
+                    value, cv_items_expended[sub_plan], synonym_index
+                )
+            except Exception as e:
+                print(
+                    f"\tFailed to expand {value} for property {prop_name} in study: {e}"
+                )
+
+        # Nested entities
+        elif type(value) == dict:
+            expend_cv_values_with_plan(
+                value, sub_plan, cv_items_expended, cv_synonym_index
+            )
+        elif type(value) == list:
+            for nested_value in value:
+                if type(nested_value) == dict:
+                    expend_cv_values_with_plan(
+                        nested_value, sub_plan, cv_items_expended, cv_synonym_index
+                    )
+
+    return study
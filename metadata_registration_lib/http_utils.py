@@ -0,0 +1,490 @@
+import codecs
+import gzip
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Status codes meaning that the request was not processed by the server, the only
+# ones retried for non idempotent requests (ex: POST creating an entity)
+NON_IDEMPOTENT_RETRY_STATUS_CODES = (429, 503)
+IDEMPOTENT_METHODS = ("get", "head", "options", "put", "delete")
+
+# Bodies smaller than this (in bytes) are sent uncompressed
+COMPRESSION_MIN_SIZE = 16 * 1024
+ACCEPT_ENCODING_HEADER = {"Accept-Encoding": "gzip, deflate"}
+
+
+def encode_json_body(data, compress=None, min_size=COMPRESSION_MIN_SIZE):
+    """
+    Serialize data to a JSON request body, optionally compressed
+    Parameters:
+        - data: JSON serializable object
+        - compress (str): None, "gzip" or "deflate"
+        - min_size (int): bodies smaller than this are never compressed
+    Returns:
+        - body (bytes)
+        - headers (dict): "Content-Type" and "Content-Encoding" headers to send with the body
+    """
+    body = json.dumps(data).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+
+    if compress is None or len(body) < min_size:
+        return body, headers
+
+    if compress == "gzip":
+        body = gzip.compress(body)
+    elif compress == "deflate":
+        body = zlib.compress(body)
+    else:
+        raise Exception(f"Compression '{compress}' not supported (gzip or deflate)")
+
+    headers["Content-Encoding"] = compress
+    return body, headers
+
+
+def get_pooled_session(pool_size=10, headers=None):
+    """
+    Returns a requests session whose connection pool can serve pool_size concurrent requests
+    Parameters:
+        - pool_size (int): number of connections kept alive per host
+        - headers (dict): headers sent with every request of the session
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(ACCEPT_ENCODING_HEADER)
+    if headers is not None:
+        session.headers.update(headers)
+    return session
+
+
+def iter_json_array(res, chunk_size=64 * 1024):
+    """
+    Incrementally parse a JSON array response and yield its items one by one
+    Memory usage scales with one item instead of the whole response.
+    Parameters:
+        - res: requests response, sent with stream=True
+        - chunk_size (int): number of bytes read at once
+    """
+    json_decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(res.encoding or "utf-8")()
+    chunks = res.iter_content(chunk_size=chunk_size)
+
+    buffer = ""
+    pos = 0
+    started = False
+    exhausted = False
+
+    while True:
+        # Skip whitespaces and items separators
+        while pos < len(buffer) and (
+            buffer[pos].isspace() or (started and buffer[pos] == ",")
+        ):
+            pos += 1
+
+        need_more = pos == len(buffer)
+        if not need_more:
+            if not started:
+                if buffer[pos] != "[":
+                    raise Exception("Response is not a JSON array")
+                started = True
+                pos += 1
+                continue
+
+            if buffer[pos] == "]":
+                return
+
+            try:
+                item, end = json_decoder.raw_decode(buffer, pos)
+                # An item ending with the buffer might be truncated (ex: numbers)
+                need_more = end == len(buffer) and not exhausted
+            except json.JSONDecodeError:
+                if exhausted:
+                    raise
+                need_more = True
+
+            if not need_more:
+                yield item
+                pos = end
+                continue
+
+        if exhausted:
+            raise Exception("Incomplete JSON array in response")
+
+        # Read next chunks, dropping already parsed items from the buffer
+        # The unparsed part is at least doubled before decoding again, so an item split
+        # across many chunks is decoded a logarithmic number of times (linear total cost)
+        pieces = [buffer[pos:]]
+        length = len(pieces[0])
+        target_length = max(2 * length, 1)
+        while length < target_length and not exhausted:
+            chunk = next(chunks, None)
+            if chunk is None:
+                pieces.append(text_decoder.decode(b"", final=True))
+                exhausted = True
+            else:
+                pieces.append(text_decoder.decode(chunk))
+            length += len(pieces[-1])
+        buffer = "".join(pieces)
+        pos = 0
+
+
+class DiskCache:
+    """
+    On-disk cache of GET responses with a size bounded LRU eviction
+    Each entry is stored as two files: "<key>.body" (raw response body) and
+    "<key>.meta" (ETag / Last-Modified headers). The modification time of the meta
+    file is used as last access time.
+    """
+
+    def __init__(self, directory, max_size=512 * 1024 * 1024, evict_ratio=0.9):
+        """
+        :param directory: directory where the entries are stored (created if missing)
+        :param max_size: maximum total size of the cached bodies in bytes
+        :param evict_ratio: once max_size is exceeded, entries are evicted until the cache
+            fits in evict_ratio * max_size, so that the directory is not scanned on every set
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.evict_ratio = evict_ratio
+        os.makedirs(directory, exist_ok=True)
+
+        # Running total of the cached bodies size, loaded on first use
+        self.total_size = None
+        self.size_lock = threading.RLock()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} (directory: {self.directory}, max size: {self.max_size})>"
+
+    @staticmethod
+    def get_key(url, mask=None):
+        return hashlib.sha256(f"{url}|{mask}".encode("utf-8")).hexdigest()
+
+    def _path(self, key, ext):
+        return os.path.join(self.directory, f"{key}.{ext}")
+
+    def get(self, key):
+        """Returns (meta dict, body bytes) or None if the entry is not cached"""
+        try:
+            with open(self._path(key, "meta"), "r") as f:
+                meta = json.load(f)
+            with open(self._path(key, "body"), "rb") as f:
+                body = f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+        return meta, body
+
+    def touch(self, key):
+        """Mark an entry as recently used"""
+        try:
+            os.utime(self._path(key, "meta"))
+        except FileNotFoundError:
+            pass
+
+    def _get_body_size(self, key):
+        try:
+            return os.path.getsize(self._path(key, "body"))
+        except FileNotFoundError:
+            return 0
+
+    def _scan_entries(self):
+        """Returns a list of (last_access, key, size) for all cached entries"""
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(".meta"):
+                continue
+            key = file_name[: -len(".meta")]
+            try:
+                last_access = os.path.getmtime(self._path(key, "meta"))
+                size = os.path.getsize(self._path(key, "body"))
+            except FileNotFoundError:
+                continue
+            entries.append((last_access, key, size))
+        return entries
+
+    def get_total_size(self):
+        """Total size of the cached bodies, the directory is only scanned once"""
+        with self.size_lock:
+            if self.total_size is None:
+                self.total_size = sum(size for _, _, size in self._scan_entries())
+            return self.total_size
+
+    def set(self, key, body, etag=None, last_modified=None):
+        meta = {"etag": etag, "last_modified": last_modified, "size": len(body)}
+
+        with self.size_lock:
+            self.get_total_size()
+            previous_size = self._get_body_size(key)
+
+            # Write to temporary files first so that readers never see partial entries
+            for ext, mode, content in [("body", "wb", body), ("meta", "w", None)]:
+                tmp_id = f"{os.getpid()}_{threading.get_ident()}"
+                tmp_path = self._path(key, f"{ext}.{tmp_id}.tmp")
+                with open(tmp_path, mode) as f:
+                    if content is None:
+                        json.dump(meta, f)
+                    else:
+                        f.write(content)
+                os.replace(tmp_path, self._path(key, ext))
+
+            self.total_size += len(body) - previous_size
+            if self.total_size > self.max_size:
+                self.evict()
+
+    def delete(self, key):
+        with self.size_lock:
+            size = self._get_body_size(key)
+            for ext in ["meta", "body"]:
+                try:
+                    os.remove(self._path(key, ext))
+                except FileNotFoundError:
+                    pass
+            if self.total_size is not None:
+                self.total_size = max(self.total_size - size, 0)
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in evict_ratio * max_size
+        The directory is scanned again, which also resynchronizes the running total
+        (ex: entries written by other processes)
+        """
+        with self.size_lock:
+            entries = self._scan_entries()
+            self.total_size = sum(size for _, _, size in entries)
+            target_size = self.max_size * self.evict_ratio
+            for _, key, _ in sorted(entries):
+                if self.total_size <= target_size:
+                    break
+                self.delete(key)
+
+    def clear(self):
+        with self.size_lock:
+            for file_name in os.listdir(self.directory):
+                if file_name.endswith(".meta"):
+                    self.delete(file_name[: -len(".meta")])
+            self.total_size = 0
+
+
+def cached_get(url, cache, mask=None, headers=None, session=None):
+    """
+    GET request returning the JSON response, served from cache when unchanged
+    Cached entries are revalidated with a conditional request (If-None-Match /
+    If-Modified-Since), a "304 Not Modified" response is served from the cache.
+    Parameters:
+        - url (str): URL to call
+        - cache (DiskCache): cache storing the responses
+        - mask (str): Mask string to be used in the X-Fields header of the request
+        - headers (dict): additional headers
+        - session: requests session (or requests module by default)
+    """
+    session = session if session is not None else requests
+    key = cache.get_key(url, mask)
+    cached_entry = cache.get(key)
+
+    request_headers = {**ACCEPT_ENCODING_HEADER, **(headers or {})}
+    if mask is not None:
+        request_headers["X-Fields"] = mask
+    if cached_entry is not None:
+        meta, _ = cached_entry
+        if meta["etag"] is not None:
+            request_headers["If-None-Match"] = meta["etag"]
+        if meta["last_modified"] is not None:
+            request_headers["If-Modified-Since"] = meta["last_modified"]
+
+    res = session.get(url, headers=request_headers)
+
+    if res.status_code == 304 and cached_entry is not None:
+        cache.touch(key)
+        return json.loads(cached_entry[1])
+
+    if res.status_code != 200:
+        raise Exception(f"Failed GET request on {url}. {res.json()}")
+
+    etag = res.headers.get("ETag")
+    last_modified = res.headers.get("Last-Modified")
+    if etag is not None or last_modified is not None:
+        cache.set(key, res.content, etag=etag, last_modified=last_modified)
+
+    return res.json()
+
+
+class TokenBucket:
+    """Thread safe token bucket used to cap the request rate sent to the API"""
+
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: number of tokens (requests) added per second
+        :param capacity: maximum number of tokens stored (burst size), defaults to rate
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} (rate: {self.rate}, capacity: {self.capacity})>"
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.last_refill) * self.rate
+        )
+        self.last_refill = now
+
+    def acquire(self):
+        """Block until a token is available and consume it"""
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class AdaptiveConcurrency:
+    """
+    Concurrency limit adapted to the API health (AIMD)
+        - Additive increase when requests succeed with a latency below target_latency
+        - Multiplicative decrease on throttling / server errors or slow responses
+    """
+
+    def __init__(
+        self, min_limit=1, max_limit=16, initial_limit=None, target_latency=2.0
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(initial_limit if initial_limit is not None else min_limit)
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} (limit: {int(self.limit)}, "
+            f"min: {self.min_limit}, max: {self.max_limit})>"
+        )
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, success=True):
+        with self.condition:
+            self.in_flight -= 1
+            if not success or (latency is not None and latency > self.target_latency):
+                self.limit = max(self.min_limit, self.limit / 2)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / max(self.limit, 1))
+            self.condition.notify_all()
+
+
+class RequestScheduler:
+    """
+    Client side scheduler for requests sent to the registration API
+    Combines a token bucket (rate), an adaptive concurrency limit and retries
+    with jittered exponential backoff on 429 and 5xx responses.
+    Requests whose method is not in idempotent_methods (ex: POST) could be processed
+    twice if sent again, they are only retried on 429 and 503 responses (not on other
+    5xx responses nor connection errors).
+    """
+
+    def __init__(
+        self,
+        rate=10,
+        burst=None,
+        min_concurrency=1,
+        max_concurrency=16,
+        target_latency=2.0,
+        max_retries=5,
+        backoff_base=0.5,
+        backoff_max=30,
+        session=None,
+        idempotent_methods=IDEMPOTENT_METHODS,
+    ):
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = AdaptiveConcurrency(
+            min_limit=min_concurrency,
+            max_limit=max_concurrency,
+            target_latency=target_latency,
+        )
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.session = session if session is not None else requests
+        self.idempotent_methods = {m.lower() for m in idempotent_methods}
+
+    def __repr__(self):
+        return (
+            f"<{self.__class__.__name__} (bucket: {self.bucket}, "
+            f"concurrency: {self.concurrency}, max retries: {self.max_retries})>"
+        )
+
+    def get_backoff_time(self, attempt, res=None):
+        """Full jitter backoff, the "Retry-After" header is used as lower bound if present"""
+        backoff_time = random.uniform(
+            0, min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        )
+        if res is not None:
+            try:
+                backoff_time = max(backoff_time, float(res.headers["Retry-After"]))
+            except (KeyError, ValueError):
+                pass
+        return backoff_time
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request (same parameters as requests.request) once allowed by the scheduler
+        Returns the last response, even if it still has a retryable status code
+        """
+        idempotent = method.lower() in self.idempotent_methods
+        if idempotent:
+            retry_status_codes = RETRY_STATUS_CODES
+        else:
+            retry_status_codes = NON_IDEMPOTENT_RETRY_STATUS_CODES
+
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            self.concurrency.acquire()
+            start = time.monotonic()
+            res = None
+            try:
+                res = self.session.request(method, url, **kwargs)
+            except requests.ConnectionError:
+                if attempt == self.max_retries or not idempotent:
+                    raise
+            finally:
+                success = res is not None and res.status_code not in RETRY_STATUS_CODES
+                self.concurrency.release(time.monotonic() - start, success)
+
+            retry = res is None or res.status_code in retry_status_codes
+            if not retry or attempt == self.max_retries:
+                return res
+
+            time.sleep(self.get_backoff_time(attempt, res))
+
+    def map(self, func, items):
+        """
+        Apply func to every item using up to max_concurrency threads
+        func is expected to send its requests through this scheduler
+        (e.g. upload_study_related_entity(..., scheduler=scheduler)).
+        Results are returned in the order of items.
+        """
+        with ThreadPoolExecutor(max_workers=self.concurrency.max_limit) as executor:
+            return list(executor.map(func, items))
@@ -1,9 +1,10 @@
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+from itertools import islice
 import abc
+import csv
 import uuid
+import weakref
 import json
-import re
-import copy
 
 from metadata_registration_lib.other_utils import str_to_bool
 
@@ -80,34 +81,13 @@ class EntitySet:
         validate_all = True
         errors_html = []
         for tmp_id, entity_dict in self.id_to_form_format.items():
-            validate_entity = True
-            field_error_list = []
-
-            # Update entity format (ex: transform strings to booleans when needed)
-            # Conversion the other way around to fill JExcel in build_xxx_session_from_form_format
-            for field in form:
-                if field.name in entity_dict:
-                    if field.type == "BooleanField":
-                        entity_dict[field.name] = str_to_bool(entity_dict[field.name])
-
-            form.process(data=entity_dict)
-
-            # Validate field by field
-            for field in form:
-                condition_1 = field.flags.required and not field.validate(form)
-                condition_2 = field.name in entity_dict and not field.validate(form)
-
-                if condition_1 or condition_2:
-                    field_error_list.append(
-                        f"Field '<b>{field.name}</b>' did not validate: {field.errors}"
-                    )
-                    validate_entity = False
-                    validate_all = False
+            field_errors = get_form_validation_errors(form, entity_dict)
 
-            if not validate_entity:
+            if len(field_errors) > 0:
+                validate_all = False
                 message = f"<b>{tmp_id}</b> did not validate against form '{form_name}'<ul style='margin-bottom:0;'>"
-                for field_error in field_error_list:
-                    message += f"<li>{field_error}</li>"
+                for field_name, errors in field_errors:
+                    message += f"<li>Field '<b>{field_name}</b>' did not validate: {errors}</li>"
                 message += f"</ul>"
                 errors_html.append(message)
 
@@ -200,66 +180,212 @@ class Step(metaclass=abc.ABCMeta):
             "multiple": multiple,
         }
 
-    def set_id_form_format_from_jexcel_data(self, form_fields, sample_steps):
+    def get_jexcel_column_plan(self, form_fields, sample_steps):
         """
-        Convert JExel data to form format (see register_samples_post docstring)
-        Also generates UUIDs for each entity
+        Compile once per sheet how each JExcel column is converted to form format
+        Returns a list (one element per column of self.entity_set.prop_names) of tuples:
+            (prop_name, kind, nested_step, nested_id_to_form)
+        kind:
+            - "nested": reference to an entity of a nested step (TMP ID)
+            - "multiple": multiple values separated by ";"
+            - "form": form field
+            - "user_json": any other property, stored in self.json_str_prop
+        """
+        nested_step_names = {s.name for s in self.nested_steps}
+        prop_names_multiple = set(self.prop_names_multiple)
+        form_fields = set(form_fields)
+
+        plan = []
+        for prop_name in self.entity_set.prop_names:
+            if prop_name in nested_step_names:
+                nested_step = sample_steps.get_step_by_name(prop_name)
+                nested_id_to_form = nested_step.entity_set.id_to_form_format
+                plan.append((prop_name, "nested", nested_step, nested_id_to_form))
+            elif prop_name in prop_names_multiple:
+                plan.append((prop_name, "multiple", None, None))
+            elif prop_name in form_fields:
+                plan.append((prop_name, "form", None, None))
+            else:
+                plan.append((prop_name, "user_json", None, None))
+
+        return plan
+
+    def get_jexcel_columns(self, columns=None):
+        """
+        Returns (n_rows, columns): the sheet as a list of columns (one list of values
+        per element of self.entity_set.prop_names)
         Parameters:
-            - form_fields: Allowed form fields, any property not here will be stored in self.json_str_prop
+            - columns: Optional dict {prop_name: sequence of values}. Sequences can be lists,
+                tuples or array-like objects with a "tolist" method (ex: NumPy arrays).
+                It replaces self.entity_set.prop_names and empties self.entity_set.jexcel_data
+                (like set_id_form_format_from_sheet). If None, the rows of
+                self.entity_set.jexcel_data are used.
         """
-        id_to_form_format = OrderedDict()
-        for entity_as_list in self.entity_set.jexcel_data:
-            entity_dict = {}
-            user_json = {}
-            for prop_name, value in zip(self.entity_set.prop_names, entity_as_list):
+        if columns is None:
+            rows = self.entity_set.jexcel_data
+            n_columns = len(self.entity_set.prop_names)
+            return len(rows), get_columns_from_rows(rows, n_columns)
+
+        self.entity_set.prop_names = list(columns.keys())
+        self.entity_set.jexcel_data = []
+        column_list = []
+        for values in columns.values():
+            if hasattr(values, "tolist"):
+                column_list.append(values.tolist())
+            else:
+                column_list.append(list(values))
 
-                if prop_name in self.prop_names_multiple:
-                    value = [v.strip() for v in re.split(";", value)]
+        n_rows = len(column_list[0]) if len(column_list) > 0 else 0
+        if any(len(values) != n_rows for values in column_list):
+            raise Exception("All columns must have the same number of values")
 
-                # Nest referenced objects (using TMP ID)
-                if prop_name in [s.name for s in self.nested_steps]:
-                    nested_step = sample_steps.get_step_by_name(prop_name)
-                    nested_id_to_form = nested_step.entity_set.id_to_form_format
+        return n_rows, column_list
 
-                    if not value in nested_id_to_form:
-                        if not nested_step.optional:
-                            raise Exception(
-                                f"<b>{prop_name}</b> is requiered for each {self.name}"
-                            )
+    def convert_jexcel_columns(self, plan, columns):
+        """
+        Convert whole columns at once (TMP ID lookups, ";" splits...) following the plan
+        Returns a list of tuples (in_user_json, prop_name, values), SKIPPED_VALUE marks
+        the values that must not be added to the entity
+        """
+        converted_columns = []
+        for column, values in zip(plan, columns):
+            prop_name, kind, nested_step, nested_id_to_form = column
+
+            # Nest referenced objects (using TMP ID)
+            if kind == "nested":
+                nested_values = []
+                for v in values:
+                    if v in nested_id_to_form:
+                        nested_values.append(nested_id_to_form[v])
+                    elif v is SKIPPED_VALUE or nested_step.optional:
+                        nested_values.append(SKIPPED_VALUE)
                     else:
-                        entity_dict[nested_step.prop_name_in_db] = nested_id_to_form[
-                            value
-                        ]
+                        raise Exception(
+                            f"<b>{prop_name}</b> is requiered for each {self.name}"
+                        )
+                converted_columns.append(
+                    (False, nested_step.prop_name_in_db, nested_values)
+                )
 
-                # List property
-                elif type(value) == list and len(value) > 0:
-                    entity_dict[prop_name] = value
+            # List property
+            elif kind == "multiple":
+                converted_columns.append(
+                    (False, prop_name, split_multiple_values(values))
+                )
 
-                # Regular property
-                elif value != "":
-                    if prop_name in form_fields:
-                        entity_dict[prop_name] = value
-                    else:
-                        user_json[prop_name] = value
+            # Regular property
+            else:
+                converted_columns.extend(
+                    convert_regular_jexcel_column(
+                        prop_name, values, in_user_json=kind == "user_json"
+                    )
+                )
+
+        return converted_columns
+
+    def get_entity_uuid(self, entity_dict):
+        """Generates UUID or take it from existing samples"""
+        id_prop = self.prop_name_for_tmp_id
+        if len(self.id_to_uuid) > 0 and entity_dict[id_prop]:
+            return self.id_to_uuid.get(entity_dict[id_prop], str(uuid.uuid1()))
+        return str(uuid.uuid1())
+
+    def add_entities_from_jexcel_columns(
+        self, converted_columns, n_rows, id_to_form_format
+    ):
+        """
+        Build one entity (form format) per row from converted columns
+        (see convert_jexcel_columns) and add it to id_to_form_format
+        """
+        keys = [(c[0], c[1]) for c in converted_columns]
+        rows = zip(*[c[2] for c in converted_columns])
+        if len(converted_columns) == 0:
+            rows = [()] * n_rows
+
+        for row in rows:
+            entity_dict = {}
+            user_json = {}
+            for (in_user_json, prop_name), value in zip(keys, row):
+                if value is SKIPPED_VALUE:
+                    continue
+                if in_user_json:
+                    user_json[prop_name] = value
+                else:
+                    entity_dict[prop_name] = value
 
             # Generates self.json_str_prop field
             if len(user_json) > 0:
                 entity_dict[self.json_str_prop] = json.dumps(user_json)
 
-            # Generates TMP ID
+            # Generates TMP ID and UUID
             tmp_id = self.get_tmp_id(entity_dict)
-
-            # Generates UUID or take it from existing samples
-            id_prop = self.prop_name_for_tmp_id
-            if len(self.id_to_uuid) > 0 and entity_dict[id_prop]:
-                entity_dict["uuid"] = self.id_to_uuid.get(
-                    entity_dict[id_prop], str(uuid.uuid1())
-                )
-            else:
-                entity_dict["uuid"] = str(uuid.uuid1())
+            entity_dict["uuid"] = self.get_entity_uuid(entity_dict)
 
             id_to_form_format[tmp_id] = entity_dict
 
+    def set_id_form_format_from_jexcel_data(
+        self, form_fields, sample_steps, columns=None
+    ):
+        """
+        Convert JExel data to form format (see register_samples_post docstring)
+        Also generates UUIDs for each entity
+        Parameters:
+            - form_fields: Allowed form fields, any property not here will be stored in self.json_str_prop
+            - columns: Optional column-oriented data used instead of self.entity_set.jexcel_data
+                (see get_jexcel_columns)
+        """
+        n_rows, columns = self.get_jexcel_columns(columns)
+        plan = self.get_jexcel_column_plan(form_fields, sample_steps)
+        converted_columns = self.convert_jexcel_columns(plan, columns)
+
+        id_to_form_format = OrderedDict()
+        self.add_entities_from_jexcel_columns(
+            converted_columns, n_rows, id_to_form_format
+        )
+        self.entity_set.id_to_form_format = id_to_form_format
+
+    def set_id_form_format_from_sheet(
+        self,
+        sheet_file,
+        form_fields,
+        file_format="csv",
+        sheet_name=None,
+        batch_size=1000,
+        **kwargs,
+    ):
+        """
+        Same as set_id_form_format_from_jexcel_data but streams a CSV or XLSX sheet
+        (first row = prop names) batch by batch instead of using self.entity_set.jexcel_data.
+        The raw sheet is never fully loaded in memory.
+        Parameters:
+            - sheet_file: Path or file object (see iter_sheet_rows)
+            - form_fields: Allowed form fields, any property not here will be stored in self.json_str_prop
+            - file_format: "csv" or "xlsx"
+            - sheet_name: XLSX sheet to read, the active one by default
+            - batch_size: Number of rows converted at once
+            - kwargs: Extra arguments of get_jexcel_column_plan (ex: sample_steps)
+        """
+        rows = iter_sheet_rows(sheet_file, file_format, sheet_name)
+        header = next(rows, None)
+        if header is None:
+            raise Exception(f"The {self.name} sheet is empty")
+
+        self.entity_set.prop_names = [prop_name.strip() for prop_name in header]
+        self.entity_set.jexcel_data = []
+        n_columns = len(self.entity_set.prop_names)
+        plan = self.get_jexcel_column_plan(form_fields, **kwargs)
+
+        id_to_form_format = OrderedDict()
+        while True:
+            batch = list(islice(rows, batch_size))
+            if len(batch) == 0:
+                break
+            columns = get_columns_from_rows(batch, n_columns)
+            converted_columns = self.convert_jexcel_columns(plan, columns)
+            self.add_entities_from_jexcel_columns(
+                converted_columns, len(batch), id_to_form_format
+            )
+
         self.entity_set.id_to_form_format = id_to_form_format
 
     def set_id_form_format_from_form_format(self, data):
@@ -285,15 +411,17 @@ class Step(metaclass=abc.ABCMeta):
         Parameters:
             - entites: list of entities dict (form format)
         Output:
-            - wrong_entities: list of dict: {id: xxx, type: xxx}
+            - wrong_entities: list of dict: {id: xxx, type: xxx, entities: [xxx, xxx]}
                 ==> List of entities having same ids while being different
+                    "entities" contains the first entity found with this id and the
+                    conflicting one (each conflicting version is reported once)
         """
         wrong_entities = []
 
-        # Structure to store and retrieve unique entities by UUID
+        # Structure to store and retrieve the first entity found by ID
         id_to_entity = {}
+        reported_conflicts = set()
 
-        # Store existing entities with UUIDs
         for entity in entities:
             bare_entity = get_step_entity_from_form_format(entity, self.name, self)
 
@@ -301,12 +429,24 @@ class Step(metaclass=abc.ABCMeta):
                 continue
 
             entity_id = bare_entity[self.prop_name_for_tmp_id]
+            entity_key = get_hashable_entity(bare_entity)
 
             if not entity_id in id_to_entity:
-                id_to_entity[entity_id] = bare_entity
+                id_to_entity[entity_id] = (entity_key, bare_entity)
             else:
-                if id_to_entity[entity_id] != bare_entity:
-                    wrong_entities.append({"type": self.name, "id": entity_id})
+                first_key, first_entity = id_to_entity[entity_id]
+                if (
+                    entity_key != first_key
+                    and not (entity_id, entity_key) in reported_conflicts
+                ):
+                    reported_conflicts.add((entity_id, entity_key))
+                    wrong_entities.append(
+                        {
+                            "type": self.name,
+                            "id": entity_id,
+                            "entities": [first_entity, bare_entity],
+                        }
+                    )
 
         return wrong_entities
 
@@ -467,92 +607,127 @@ class StepReadouts(Step):
         self.prop_names_multiple = ["samples"]
         super().__init__(*args, **kwargs)
 
-    def set_id_form_format_from_jexcel_data(self, form_fields):
+    def get_jexcel_column_plan(self, form_fields):
         """
-        Convert JExel data to form format (see register_samples_post docstring)
-        Also generates UUIDs for each entity
-        INFO: JExcel concatenates string values with ";" for dropdowns with multiple choices
-        Parameters:
-            - form_fields: Allowed form fields, any property not here will be stored in self.json_str_prop
+        Compile once per sheet how each JExcel column is converted to form format
+        Returns a list (one element per column of self.entity_set.prop_names) of tuples:
+            (prop_name, kind, multiple, prop_name_in_db, related_index)
+        kind:
+            - "related": reference to related entities (TMP IDs), related_index maps
+                each TMP ID to the full entity (nest_obj_required) or its UUID (obj_uuid_required)
+            - "multiple": multiple values separated by ";"
+            - "form": form field
+            - "user_json": any other property, stored in self.json_str_prop
         """
-        id_to_form_format = OrderedDict()
+        nest_obj_required = set(self.nest_obj_required)
+        related_prop_names = nest_obj_required | set(self.obj_uuid_required)
+        prop_names_multiple = set(self.prop_names_multiple)
+        form_fields = set(form_fields)
 
-        related_id_to_obj = {}
+        plan = []
         for prop_name in self.entity_set.prop_names:
-            if prop_name in self.nest_obj_required + self.obj_uuid_required:
+            multiple = prop_name in prop_names_multiple
+
+            if prop_name in related_prop_names:
                 # Ex: ReadoutSet must have a "sample_set" attribute that is a SampleSet
                 if prop_name == "samples":
                     entity_set_attr = "sample_set"
                 else:
                     entity_set_attr = prop_name
                 entity_set = getattr(self.entity_set, entity_set_attr)
-                related_id_to_obj[prop_name] = entity_set.id_to_form_format
 
-        for entity_as_list in self.entity_set.jexcel_data:
-            entity_dict = {}
-            user_json = {}
-            for j in range(len(entity_as_list)):
-                prop_name = self.entity_set.prop_names[j]
-                value = entity_as_list[j]
-
-                if prop_name in self.prop_names_multiple:
-                    value = [v.strip() for v in re.split(";", value)]
-
-                # Nest referenced objects (using TMP ID)
-                if prop_name in self.nest_obj_required + self.obj_uuid_required:
-                    prop_name_in_db = self.entity_name_to_db_name[prop_name]
-
-                    if type(value) == list:
-                        if not all([v in related_id_to_obj[prop_name] for v in value]):
-                            raise Exception(
-                                f"<b>{prop_name}</b> missing or wrong for at least one {self.name}"
-                            )
-
-                        # Nest full object or take UUID only
-                        if prop_name in self.nest_obj_required:
-                            entity_dict[prop_name_in_db] = [
-                                related_id_to_obj[prop_name][v] for v in value
-                            ]
-                        elif prop_name in self.obj_uuid_required:
-                            entity_dict[prop_name_in_db] = [
-                                related_id_to_obj[prop_name][v]["uuid"] for v in value
-                            ]
-                    else:
-                        if not value in related_id_to_obj[prop_name]:
-                            raise Exception(
-                                f"<b>{prop_name}</b> missing or wrong for at least one {self.name}"
-                            )
-
-                        # Nest full object or take UUID only
-                        if prop_name in self.nest_obj_required:
-                            entity_dict[prop_name_in_db] = related_id_to_obj[prop_name][
-                                value
-                            ]
-                        elif prop_name in self.obj_uuid_required:
-                            entity_dict[prop_name_in_db] = related_id_to_obj[prop_name][
-                                value
-                            ]["uuid"]
-
-                # List property
-                elif type(value) == list and len(value) > 0:
-                    entity_dict[prop_name] = value
+                # Nest full object or take UUID only
+                if prop_name in nest_obj_required:
+                    related_index = entity_set.id_to_form_format
+                else:
+                    related_index = {
+                        tmp_id: entity["uuid"]
+                        for tmp_id, entity in entity_set.id_to_form_format.items()
+                    }
+
+                prop_name_in_db = self.entity_name_to_db_name[prop_name]
+                plan.append(
+                    (prop_name, "related", multiple, prop_name_in_db, related_index)
+                )
+            elif multiple:
+                plan.append((prop_name, "multiple", True, None, None))
+            elif prop_name in form_fields:
+                plan.append((prop_name, "form", False, None, None))
+            else:
+                plan.append((prop_name, "user_json", False, None, None))
+
+        return plan
 
-                # Regular property
-                elif value != "":
-                    if prop_name in form_fields:
-                        entity_dict[prop_name] = value
+    def convert_jexcel_columns(self, plan, columns):
+        """
+        Convert whole columns at once (TMP ID lookups, ";" splits...) following the plan
+        INFO: JExcel concatenates string values with ";" for dropdowns with multiple choices
+        Returns a list of tuples (in_user_json, prop_name, values), SKIPPED_VALUE marks
+        the values that must not be added to the entity
+        """
+        converted_columns = []
+        for column, values in zip(plan, columns):
+            prop_name, kind, multiple, prop_name_in_db, related_index = column
+
+            if multiple:
+                values = split_multiple_values(values)
+
+            # Nest referenced objects (using TMP ID)
+            if kind == "related":
+                try:
+                    if multiple:
+                        values = [
+                            value
+                            if value is SKIPPED_VALUE
+                            else [related_index[v] for v in value]
+                            for value in values
+                        ]
                     else:
-                        user_json[prop_name] = value
+                        values = [
+                            v if v is SKIPPED_VALUE else related_index[v]
+                            for v in values
+                        ]
+                except KeyError:
+                    raise Exception(
+                        f"<b>{prop_name}</b> missing or wrong for at least one {self.name}"
+                    )
+                converted_columns.append((False, prop_name_in_db, values))
 
-            # Generates self.json_str_prop field
-            if len(user_json) > 0:
-                entity_dict[self.json_str_prop] = json.dumps(user_json)
+            # List property
+            elif multiple:
+                converted_columns.append((False, prop_name, values))
 
-            # Generates UUID and TMP ID
-            tmp_id = self.get_tmp_id(entity_dict)
-            entity_dict["uuid"] = str(uuid.uuid1())
-            id_to_form_format[tmp_id] = entity_dict
+            # Regular property
+            else:
+                converted_columns.extend(
+                    convert_regular_jexcel_column(
+                        prop_name, values, in_user_json=kind == "user_json"
+                    )
+                )
+
+        return converted_columns
 
+    def get_entity_uuid(self, entity_dict):
+        """Readouts always get a new UUID"""
+        return str(uuid.uuid1())
+
+    def set_id_form_format_from_jexcel_data(self, form_fields, columns=None):
+        """
+        Convert JExel data to form format (see register_samples_post docstring)
+        Also generates UUIDs for each entity
+        Parameters:
+            - form_fields: Allowed form fields, any property not here will be stored in self.json_str_prop
+            - columns: Optional column-oriented data used instead of self.entity_set.jexcel_data
+                (see get_jexcel_columns)
+        """
+        n_rows, columns = self.get_jexcel_columns(columns)
+        plan = self.get_jexcel_column_plan(form_fields)
+        converted_columns = self.convert_jexcel_columns(plan, columns)
+
+        id_to_form_format = OrderedDict()
+        self.add_entities_from_jexcel_columns(
+            converted_columns, n_rows, id_to_form_format
+        )
         self.entity_set.id_to_form_format = id_to_form_format
 
 
@@ -603,45 +778,188 @@ class StepsSamples:
         raise Exception(f"Step name prefix '{name_prefix}' was not found")
 
 
+# Immutable step metadata shared by the per sample loops (no entity sets, no HTML)
+StepDefinition = namedtuple(
+    "StepDefinition",
+    [
+        "number",
+        "name",
+        "prop_name_in_db",
+        "prop_name_for_tmp_id",
+        "form_name",
+        "optional",
+        "is_final",
+        "prop_names_multiple",
+        "nested_step_names",
+    ],
+)
+
+
+def get_step_definition(step):
+    return StepDefinition(
+        number=step.number,
+        name=step.name,
+        prop_name_in_db=step.prop_name_in_db,
+        prop_name_for_tmp_id=step.prop_name_for_tmp_id,
+        form_name=step.form_name,
+        optional=step.optional,
+        is_final=step.is_final,
+        prop_names_multiple=tuple(step.prop_names_multiple),
+        nested_step_names=tuple(s.name for s in step.nested_steps),
+    )
+
+
+# Sample steps in correct order, built once
+SAMPLE_STEPS = tuple(get_step_definition(step) for step in StepsSamples().steps)
+
+
 ###################################################
 ####### Other functions
 ###################################################
+# Marks the values of a converted JExcel column that must not be added to the entity
+SKIPPED_VALUE = object()
+
+
+def get_columns_from_rows(rows, n_columns):
+    """
+    Transpose JExcel rows into n_columns lists of values
+    Extra cells are ignored and missing cells (short rows) are SKIPPED_VALUE,
+    they are ignored by the conversion like the cells of an absent column
+    """
+    return [
+        [row[j] if j < len(row) else SKIPPED_VALUE for row in rows]
+        for j in range(n_columns)
+    ]
+
+
+def iter_sheet_rows(sheet_file, file_format="csv", sheet_name=None):
+    """
+    Read a CSV or XLSX sheet row by row (lists of strings), empty rows are skipped
+    XLSX files are read with openpyxl in read-only mode (optional dependency)
+    Parameters:
+        - sheet_file: Path or file object (text mode for CSV, binary mode for XLSX)
+        - file_format: "csv" or "xlsx"
+        - sheet_name: XLSX sheet to read, the active one by default
+    """
+    if file_format == "csv":
+        if isinstance(sheet_file, str):
+            with open(sheet_file, newline="", encoding="utf-8-sig") as f:
+                yield from iter_sheet_rows(f, file_format)
+            return
+
+        for row in csv.reader(sheet_file):
+            if any(value != "" for value in row):
+                yield row
+
+    elif file_format == "xlsx":
+        try:
+            import openpyxl
+        except ImportError:
+            raise Exception("openpyxl is required to read XLSX sheets")
+
+        workbook = openpyxl.load_workbook(sheet_file, read_only=True, data_only=True)
+        try:
+            if sheet_name is None:
+                worksheet = workbook.active
+            else:
+                worksheet = workbook[sheet_name]
+
+            for values in worksheet.iter_rows(values_only=True):
+                row = ["" if value is None else str(value) for value in values]
+                if any(value != "" for value in row):
+                    yield row
+        finally:
+            workbook.close()
+
+    else:
+        raise Exception(f"Unsupported sheet format: {file_format}")
+
+
+def split_multiple_values(values):
+    """Split each value of a column on ";" and strip the resulting values"""
+    return [
+        value if value is SKIPPED_VALUE else [v.strip() for v in value.split(";")]
+        for value in values
+    ]
+
+
+def convert_regular_jexcel_column(prop_name, values, in_user_json):
+    """
+    Convert a column of regular values: empty strings are skipped and non empty lists
+    are always stored as properties (never in the user JSON)
+    Returns a list of converted columns: (in_user_json, prop_name, values)
+    """
+    values = [SKIPPED_VALUE if v == "" else v for v in values]
+    if not in_user_json or not any(type(v) == list and len(v) > 0 for v in values):
+        return [(in_user_json, prop_name, values)]
+
+    list_values = []
+    other_values = []
+    for v in values:
+        if type(v) == list and len(v) > 0:
+            list_values.append(v)
+            other_values.append(SKIPPED_VALUE)
+        else:
+            list_values.append(SKIPPED_VALUE)
+            other_values.append(v)
+
+    return [(False, prop_name, list_values), (True, prop_name, other_values)]
+
+
 def get_step_entity_from_form_format(entity, entity_type, step):
     """
     Input: entity in form format + entity_type (step name) + step object
     Output: sub-entity in form format without parent or nested entity
+    Only the first level of the sub-entity is copied: nested values (ex: lists) are
+    shared with the input entity and must not be modified.
     """
-    bare_entity = copy.deepcopy(entity)
+    nested_entity_keys = ()
+    bare_entity = entity
 
     if entity_type == "sample":
         if step.name == "sample":
-            bare_entity.pop("individual", None)
-            bare_entity.pop("treatment", None)
+            nested_entity_keys = ("individual", "treatment")
 
         elif step.name == "treatment_sam":
-            bare_entity = bare_entity.get("treatment", None)
+            bare_entity = entity.get("treatment", None)
 
         elif step.name == "individual":
-            bare_entity = bare_entity.get("individual", None)
-            if bare_entity is not None:
-                bare_entity.pop("treatment", None)
+            bare_entity = entity.get("individual", None)
+            nested_entity_keys = ("treatment",)
 
         elif step.name == "treatment_ind":
-            bare_entity = bare_entity.get("individual", {}).get("treatment", None)
+            bare_entity = entity.get("individual", {}).get("treatment", None)
 
     elif entity_type in ["treatment_sam", "treatment_ind"]:
         pass
 
     elif entity_type == "individual":
         if step.name == "individual":
-            bare_entity.pop("treatment", None)
+            nested_entity_keys = ("treatment",)
 
         elif step.name == "treatment_ind":
-            bare_entity = bare_entity.get("treatment", None)
+            bare_entity = entity.get("treatment", None)
 
     # For readouts, nothing to do
 
-    return bare_entity
+    if bare_entity is None:
+        return None
+
+    return {k: v for k, v in bare_entity.items() if k not in nested_entity_keys}
+
+
+def get_hashable_entity(value):
+    """
+    Returns a hashable version of an entity (form format) to use it as dict key
+    Equal entities give equal (and equally hashed) values: dicts become frozensets
+    of (key, value) and lists become tuples, recursively.
+    """
+    if isinstance(value, dict):
+        return frozenset((k, get_hashable_entity(v)) for k, v in value.items())
+    elif isinstance(value, list):
+        return tuple(get_hashable_entity(v) for v in value)
+    else:
+        return value
 
 
 def update_sample_step_uuid(sample, step, step_uuid):
@@ -672,45 +990,40 @@ def unify_sample_entities_uuids(existing_samples, new_samples):
     new_samples_updated = []
 
     # Structure to store and retrieve unique entities by UUID
-    unique_entities = []
-    index_to_uuid = {}
+    # Key: hashable version of the entity without uuid (see get_hashable_entity)
+    entity_to_uuid = {}
 
-    # Store existing entities with UUIDs
+    # Store existing entities with UUIDs (the first UUID found is kept)
     for sample in existing_samples:
-        for step in StepsSamples().steps:
+        for step in SAMPLE_STEPS:
             bare_entity = get_step_entity_from_form_format(sample, "sample", step)
 
-            if bare_entity is None:
+            if bare_entity is None or not "uuid" in bare_entity:
                 continue
 
-            if not bare_entity in unique_entities and "uuid" in bare_entity:
-                tmp_uuid = bare_entity.pop("uuid")
-                unique_entities.append(bare_entity)
-                index = len(index_to_uuid)
-                index_to_uuid[index] = tmp_uuid
+            tmp_uuid = bare_entity.pop("uuid")
+            entity_to_uuid.setdefault(get_hashable_entity(bare_entity), tmp_uuid)
 
     # Update or create UUIDs of new samples
     for sample in new_samples:
-        for step in StepsSamples().steps:
+        for step in SAMPLE_STEPS:
             bare_entity = get_step_entity_from_form_format(sample, "sample", step)
 
             if bare_entity is None:
                 continue
 
             potential_uuid = bare_entity.pop("uuid", None)
+            entity_key = get_hashable_entity(bare_entity)
 
-            if bare_entity in unique_entities:
-                index = unique_entities.index(bare_entity)
-                step_uuid = index_to_uuid[index]
+            if entity_key in entity_to_uuid:
+                step_uuid = entity_to_uuid[entity_key]
             else:
                 if potential_uuid is None:
                     step_uuid = str(uuid.uuid1())
                 else:
                     step_uuid = potential_uuid
 
-                unique_entities.append(bare_entity)
-                index = len(index_to_uuid)
-                index_to_uuid[index] = step_uuid
+                entity_to_uuid[entity_key] = step_uuid
 
             sample = update_sample_step_uuid(sample, step, step_uuid)
 
@@ -719,6 +1032,68 @@ def unify_sample_entities_uuids(existing_samples, new_samples):
     return new_samples_updated
 
 
+FormValidationPlan = namedtuple(
+    "FormValidationPlan",
+    ["boolean_field_names", "required_field_names", "fields"],
+)
+
+# Validation plans by form class (weak keys: dynamic form classes can be garbage collected)
+form_validation_plans = weakref.WeakKeyDictionary()
+
+
+def get_form_validation_plan(form):
+    """
+    Returns the validation plan of a form, computed once per form class
+        - boolean_field_names: fields to convert to booleans before processing the form
+        - required_field_names: fields to always validate
+        - fields: tuples (name, short_name) in form order, other fields are only
+            validated when present in the entity
+    """
+    form_class = form.__class__
+    plan = form_validation_plans.get(form_class)
+
+    if plan is None:
+        plan = FormValidationPlan(
+            boolean_field_names=tuple(
+                field.name for field in form if field.type == "BooleanField"
+            ),
+            required_field_names=frozenset(
+                field.name for field in form if field.flags.required
+            ),
+            fields=tuple((field.name, field.short_name) for field in form),
+        )
+        form_validation_plans[form_class] = plan
+
+    return plan
+
+
+def get_form_validation_errors(form, entity_dict):
+    """
+    Validate an entity (form format) against a form instance
+    entity_dict booleans are converted in place
+    Returns a list of tuples (field_name, field_errors) for fields that did not validate
+    """
+    plan = get_form_validation_plan(form)
+
+    # Update entity format (ex: transform strings to booleans when needed)
+    # Conversion the other way around to fill JExcel in build_xxx_session_from_form_format
+    for field_name in plan.boolean_field_names:
+        if field_name in entity_dict:
+            entity_dict[field_name] = str_to_bool(entity_dict[field_name])
+
+    form.process(data=entity_dict)
+
+    # Validate required fields and the ones present in the entity
+    field_errors = []
+    for field_name, short_name in plan.fields:
+        if field_name in plan.required_field_names or field_name in entity_dict:
+            field = form[short_name]
+            if not field.validate(form):
+                field_errors.append((field_name, field.errors))
+
+    return field_errors
+
+
 def validate_sample_against_form(sample, validate_dict, forms):
     """
     Performs validation of a sample (and its nested entities in form format) against forms
@@ -729,7 +1104,7 @@ def validate_sample_against_form(sample, validate_dict, forms):
     validate = True
     errors = []
 
-    for step in StepsSamples().steps:
+    for step in SAMPLE_STEPS:
         validate_step = True
         errors_step = []
         bare_entity = get_step_entity_from_form_format(sample, "sample", step)
@@ -738,27 +1113,10 @@ def validate_sample_against_form(sample, validate_dict, forms):
             continue
 
         form = forms[step.name]()
-
-        # Update entity format (ex: transform strings to booleans when needed)
-        # Conversion the other way around to fill JExcel in build_xxx_session_from_form_format
-        for field in form:
-            if field.name in bare_entity:
-                if field.type == "BooleanField":
-                    bare_entity[field.name] = str_to_bool(bare_entity[field.name])
-
-        form.process(data=bare_entity)
-
-        # Validate field by field
-        for field in form:
-            condition_1 = field.flags.required and not field.validate(form)
-            condition_2 = field.name in bare_entity and not field.validate(form)
-
-            if condition_1 or condition_2:
-                errors_step.append(
-                    f"Field '{field.name}' did not validate: {field.errors}"
-                )
-                validate_step = False
-                validate = False
+        for field_name, field_errors in get_form_validation_errors(form, bare_entity):
+            errors_step.append(f"Field '{field_name}' did not validate: {field_errors}")
+            validate_step = False
+            validate = False
 
         if not validate_step:
             error = f"Step '{step.name}' did not validate: {' / '.join(errors_step)}"
@@ -767,4 +1125,257 @@ def validate_sample_against_form(sample, validate_dict, forms):
         error_string = "ERR: " + " ERR: ".join(errors)
         raise Exception(f"Sample {sample['uuid']} did not validate: {error_string}")
 
-    return validate, errors
\ No newline at end of file
+    return validate, errors
+
+###################################################
+####### Lightweight validation from form JSON
+###################################################
+REQUIRED_VALIDATORS = ("DataRequired", "InputRequired")
+REQUIRED_MESSAGE = "This field is required."
+
+FieldRule = namedtuple(
+    "FieldRule",
+    [
+        "name",
+        "class_name",
+        "required",
+        "input_required",
+        "optional",
+        "choices",
+        "nested",
+    ],
+)
+
+
+def get_field_choices(field_json):
+    """
+    Returns the allowed values (frozenset of strings) of a SelectField or
+    SelectMultipleField JSON, None if there is no restriction
+    Choices are taken from kwargs (set by JsonFlaskParser) or from the property CV items
+    """
+    kwargs = field_json.get("kwargs") or {}
+    choices = kwargs.get("choices")
+
+    if isinstance(choices, dict):
+        choices = (choices.get("args") or {}).get("tuples", [])
+    if isinstance(choices, list):
+        return frozenset(
+            str(c[0]) if isinstance(c, (list, tuple)) else str(c) for c in choices
+        )
+
+    value_type = field_json.get("property", {}).get("value_type") or {}
+    if value_type.get("data_type") != "ctrl_voc":
+        return None
+
+    allow_synonyms = kwargs.get("allow_synonyms", False)
+    allowed_values = set()
+    for cv_item in (value_type.get("controlled_vocabulary") or {}).get("items", []):
+        allowed_values.add(cv_item["name"])
+        if allow_synonyms:
+            allowed_values.update(cv_item.get("synonyms", []))
+
+    return frozenset(allowed_values)
+
+
+def get_field_rule(field_json, name=None):
+    """Compile the validation rule of a field JSON (see FormValidator)"""
+    name = name or field_json["property"]["name"]
+    class_name = field_json.get("class_name")
+    kwargs = field_json.get("kwargs") or {}
+
+    validators_args = (kwargs.get("validators") or {}).get("args") or {}
+    validators = validators_args.get("objects") or [validators_args.get("object", {})]
+
+    # The validation chain stops at Optional (no raw form input when processed from
+    # data), so only the required validators placed before it are effective
+    required = input_required = optional = False
+    for validator in validators:
+        validator_name = validator.get("class_name")
+        if validator_name == "Optional":
+            optional = True
+            break
+        if validator_name in REQUIRED_VALIDATORS:
+            required = True
+            input_required = input_required or validator_name == "InputRequired"
+
+    choices = None
+    nested = None
+    if class_name in ["SelectField", "SelectMultipleField"]:
+        choices = get_field_choices(field_json)
+    elif class_name == "FormField":
+        nested = FormValidator(field_json)
+    elif class_name == "FieldList":
+        entry_json = (field_json.get("args") or {}).get("object", {})
+        nested = get_field_rule(entry_json, name=name)
+
+    return FieldRule(
+        name, class_name, required, input_required, optional, choices, nested
+    )
+
+
+def get_field_value_errors(rule, value):
+    """
+    Returns the list of errors of a value (empty list if valid), mimicking how
+    WTForms processes data (form.process(data=...)) before validating it
+    """
+    # Optional without a required validator before it: WTForms clears all the errors
+    if rule.optional and not rule.required:
+        return []
+
+    errors = []
+    data = value
+
+    if rule.class_name == "IntegerField":
+        if value is not None:
+            try:
+                data = int(value)
+            except (ValueError, TypeError):
+                return ["Not a valid integer value."]
+
+    elif rule.class_name == "BooleanField":
+        data = str_to_bool(value) if isinstance(value, str) else bool(value)
+
+    elif rule.class_name == "SelectField":
+        data = str(value) if value is not None else None
+        if rule.choices is not None and not data in rule.choices:
+            errors.append("Not a valid choice.")
+
+    elif rule.class_name == "SelectMultipleField":
+        try:
+            data = [str(v) for v in value]
+        except TypeError:
+            data = None
+        if data and rule.choices is not None:
+            wrong_values = [v for v in data if not v in rule.choices]
+            if len(wrong_values) > 0:
+                errors.append(f"'{', '.join(wrong_values)}' not valid choice(s).")
+
+    elif rule.class_name == "FormField":
+        if not isinstance(value, dict):
+            return ["Not a valid nested entity."]
+        nested_errors = rule.nested.validate(value)
+        if len(nested_errors) > 0:
+            errors.append(dict(nested_errors))
+
+    elif rule.class_name == "FieldList":
+        if not isinstance(value, list):
+            return ["Not a valid list."]
+        for entry in value:
+            errors.extend(get_field_value_errors(rule.nested, entry))
+
+    # InputRequired and Optional check the raw form input, which is always empty when
+    # the form is processed from data: WTForms fails InputRequired on every entity and
+    # Optional stops the validation, clearing all the errors of the field
+    if rule.input_required:
+        errors.append(REQUIRED_MESSAGE)
+    elif rule.required and not (
+        data and (not isinstance(data, str) or data.strip())
+    ):
+        errors.append(REQUIRED_MESSAGE)
+    elif rule.optional:
+        return []
+
+    return errors
+
+
+class FormValidator:
+    """
+    Lightweight validator compiled once from a form JSON (get_form_by_name(...)["json"])
+    It validates plain dicts (form format) without instantiating WTForms forms:
+        - required fields (DataRequired and InputRequired validators). Like WTForms
+            forms processed from data (see get_form_validation_errors), InputRequired
+            fields never validate since there is no raw form input, and fields with the
+            Optional validator are always valid (unless a required validator precedes it).
+        - data types given by the field classes (IntegerField, FormField, FieldList...)
+        - CV membership (SelectField and SelectMultipleField choices)
+    Other WTForms validators (ex: Length, NumberRange) are not checked.
+    """
+
+    def __init__(self, form_json):
+        self.name = form_json.get("name") or form_json.get("property", {}).get("name")
+        self.rules = tuple(
+            get_field_rule(field_json) for field_json in form_json.get("fields", [])
+        )
+
+    def validate(self, entity_dict):
+        """
+        Validate required fields and the ones present in the entity
+        Returns a list of tuples (field_name, field_errors) for fields that did not
+        validate (same format as get_form_validation_errors)
+        """
+        field_errors = []
+        for rule in self.rules:
+            if rule.name in entity_dict:
+                errors = get_field_value_errors(rule, entity_dict[rule.name])
+            elif rule.required:
+                errors = [REQUIRED_MESSAGE]
+            else:
+                continue
+
+            if len(errors) > 0:
+                field_errors.append((rule.name, errors))
+
+        return field_errors
+
+
+def validate_samples_with_form_validators(
+    samples, validate_dict, validators, forms=None
+):
+    """
+    Performs validation of samples (and their nested entities in form format) with
+    validators compiled from form JSONs, much faster than validate_sample_against_form
+    Parameters:
+        - validate_dict: {step_name: bool}, steps to validate
+        - validators: {step_name: FormValidator}
+        - forms: Optional {step_name: form class}, to cross-check with WTForms. WTForms
+            results are then used and disagreements are printed.
+    Returns
+        - validate_all (bool)
+        - errors (list of strings): one per sample that did not validate
+    """
+    validate_all = True
+    errors = []
+
+    for sample in samples:
+        errors_sample = []
+
+        for step in SAMPLE_STEPS:
+            if not validate_dict[step.name]:
+                continue
+
+            bare_entity = get_step_entity_from_form_format(sample, "sample", step)
+            if bare_entity is None:
+                continue
+
+            field_errors = validators[step.name].validate(bare_entity)
+
+            if forms is not None:
+                wtforms_errors = get_form_validation_errors(
+                    forms[step.name](), bare_entity
+                )
+                field_names = {f for f, _ in field_errors}
+                wtforms_field_names = {f for f, _ in wtforms_errors}
+                if field_names != wtforms_field_names:
+                    print(
+                        f"\tValidation mismatch for {step.name} in sample "
+                        f"{sample.get('uuid')}: {sorted(field_names)} (compiled) / "
+                        f"{sorted(wtforms_field_names)} (WTForms)"
+                    )
+                field_errors = wtforms_errors
+
+            if len(field_errors) > 0:
+                errors_step = [
+                    f"Field '{f}' did not validate: {e}" for f, e in field_errors
+                ]
+                errors_sample.append(
+                    f"Step '{step.name}' did not validate: {' / '.join(errors_step)}"
+                )
+
+        if len(errors_sample) > 0:
+            validate_all = False
+            error_string = "ERR: " + " ERR: ".join(errors_sample)
+            errors.append(
+                f"Sample {sample.get('uuid')} did not validate: {error_string}"
+            )
+
+    return validate_all, errors
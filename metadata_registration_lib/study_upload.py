@@ -1,10 +1,14 @@
-from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urljoin, urlencode
 import requests
 
 from metadata_registration_lib.api_utils import (map_key_value,
     login_and_get_header, FormatConverter)
+from metadata_registration_lib.http_utils import (encode_json_body,
+    iter_json_array, get_pooled_session, cached_get, ACCEPT_ENCODING_HEADER)
 
-def post_study(study_data, host, email=None, password=None):
+def post_study(study_data, host, email=None, password=None,
+    scheduler=None, compress=None):
     """
     The main "study_data" input should be formated as follow:
     {
@@ -39,7 +43,9 @@ def post_study(study_data, host, email=None, password=None):
         url = endpoints["study"],
         method = "post",
         property_url = endpoints["property"],
-        headers = headers
+        headers = headers,
+        scheduler = scheduler,
+        compress = compress
     )
 
     if success:
@@ -50,7 +56,8 @@ def post_study(study_data, host, email=None, password=None):
         return None
 
 
-def add_dataset_to_study(dataset_data, study_id, host, email=None, password=None):
+def add_dataset_to_study(dataset_data, study_id, host, email=None, password=None,
+    scheduler=None, compress=None):
     """
     The main "dataset_data" input should be formated as follow:
     {
@@ -84,7 +91,9 @@ def add_dataset_to_study(dataset_data, study_id, host, email=None, password=None
         url = f"{endpoints['study']}/id/{study_id}/datasets",
         method = "post",
         property_url = endpoints["property"],
-        headers = headers
+        headers = headers,
+        scheduler = scheduler,
+        compress = compress
     )
 
     if success:
@@ -95,7 +104,8 @@ def add_dataset_to_study(dataset_data, study_id, host, email=None, password=None
         return None
 
 
-def add_process_event_to_dataset(pe_data, study_id, dataset_uuid, host, email=None, password=None):
+def add_process_event_to_dataset(pe_data, study_id, dataset_uuid, host, email=None, password=None,
+    scheduler=None, compress=None):
     """
     The main "pe_data" input should be formated as follow:
     {
@@ -129,7 +139,9 @@ def add_process_event_to_dataset(pe_data, study_id, dataset_uuid, host, email=No
         url = f"{endpoints['study']}/id/{study_id}/datasets/id/{dataset_uuid}/pes",
         method = "post",
         property_url = endpoints["property"],
-        headers = headers
+        headers = headers,
+        scheduler = scheduler,
+        compress = compress
     )
 
     if success:
@@ -150,26 +162,96 @@ def get_endpoints(host):
         "login": urljoin(host, "users/login")
     }
 
-def api_get(url):
-    obj_res = requests.get(url=url)
+def api_get(url, cache=None):
+    """
+    GET request on the API returning the JSON response
+    If a "cache" (http_utils.DiskCache) is given, unchanged responses are served from it
+    """
+    if cache is not None:
+        return cached_get(url, cache)
+
+    obj_res = requests.get(url=url, headers=ACCEPT_ENCODING_HEADER)
 
     if obj_res.status_code != 200:
         raise Exception(f"Failed GET request on {url}. {obj_res.json()}")
 
     return obj_res.json()
 
-def upload_study_related_entity(data, url, method, property_url, headers):
-    """Send data to the API (study related entity) in form format"""
+def api_get_stream(url):
+    """Generator yielding the items of a JSON array response (parsed incrementally)"""
+    with requests.get(url=url, headers=ACCEPT_ENCODING_HEADER, stream=True) as obj_res:
+        if obj_res.status_code != 200:
+            raise Exception(f"Failed GET request on {url}. {obj_res.json()}")
+
+        yield from iter_json_array(obj_res)
+
+def fetch_studies(ids, study_url, mask=None, concurrency=8, headers=None, cache=None,
+    params=None):
+    """
+    Generator fetching studies by id in parallel, yielding (study_id, study_json)
+    as soon as each request completes (not in the order of ids)
+    Parameters:
+        - ids: iterable of study ids
+        - study_url: studies endpoint (see get_endpoints)
+        - mask: Mask string to be used in the X-Fields header (projection of the study fields)
+        - concurrency: maximum number of requests in flight
+        - headers: additional headers (ex: access token)
+        - cache: http_utils.DiskCache, unchanged studies are then served from it
+        - params: query parameters (ex: {"entry_format": "form"})
+    """
+    query = f"?{urlencode(params)}" if params else ""
+    request_headers = dict(headers or {})
+    if mask is not None:
+        request_headers["X-Fields"] = mask
+
+    def fetch(study_id):
+        if cache is not None:
+            return study_id, cached_get(f"{study_url}/id/{study_id}{query}", cache,
+                mask=mask, session=session)
+
+        res = session.get(f"{study_url}/id/{study_id}{query}")
+        if res.status_code != 200:
+            raise Exception(f"Failed GET request on study {study_id}. {res.json()}")
+        return study_id, res.json()
+
+    ids = iter(ids)
+    with get_pooled_session(concurrency, request_headers) as session:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # Bounded number of pending requests
+            pending = {executor.submit(fetch, i) for _, i in zip(range(2 * concurrency), ids)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+                    next_id = next(ids, None)
+                    if next_id is not None:
+                        pending.add(executor.submit(fetch, next_id))
+
+def upload_study_related_entity(data, url, method, property_url, headers, scheduler=None,
+    compress=None, prop_name_to_id=None, prop_id_to_name=None):
+    """
+    Send data to the API (study related entity) in form format
+    If a "scheduler" (http_utils.RequestScheduler) is given, all requests (including the
+    property GET) are rate limited and retried with backoff (see RequestScheduler for
+    the status codes retried depending on the method)
+    "compress" ("gzip" or "deflate") enables compression of large request bodies
+    "prop_name_to_id" ("form" entries) or "prop_id_to_name" ("api" entries) can be given
+    as precomputed property mappings to avoid fetching the properties for each entity
+    """
     entry_format = data.pop("entry_format", "form")
 
     # Format data (cleaning + conversion from "form format" to "api format")
     if entry_format == "form":
-        prop_name_to_id = map_key_value(property_url, key="name", value="id")
+        if prop_name_to_id is None:
+            prop_name_to_id = map_key_value(property_url, key="name", value="id",
+                scheduler=scheduler)
         converter = FormatConverter(mapper=prop_name_to_id)
         converter.add_form_format(data["entries"])
 
     elif entry_format == "api":
-        prop_id_to_name = map_key_value(property_url, key="id", value="name")
+        if prop_id_to_name is None:
+            prop_id_to_name = map_key_value(property_url, key="id", value="name",
+                scheduler=scheduler)
         converter = FormatConverter(mapper=prop_id_to_name)
         converter.add_api_format(data["entries"])
 
@@ -178,8 +260,12 @@ def upload_study_related_entity(data, url, method, property_url, headers):
     data["entry_format"] = "api"
 
     # Send data to API
+    send = scheduler.request if scheduler is not None else requests.request
+    body, body_headers = encode_json_body(data, compress=compress)
+    headers = {**headers, **body_headers}
+
     if method == "post":
-        res = requests.post(url=url, json=data, headers=headers)
+        res = send("post", url=url, data=body, headers=headers)
         if res.status_code != 201:
             message = f"Failed to POST study related entity. {res.json()}"
             success = False
@@ -188,7 +274,7 @@ def upload_study_related_entity(data, url, method, property_url, headers):
             success = True
 
     elif method == "put":
-        res = requests.put(url=url, json=data, headers=headers)
+        res = send("put", url=url, data=body, headers=headers)
         if res.status_code != 200:
             message = f"Failed to PUT study related entity. {res.json()}"
             success = False
@@ -42,7 +42,8 @@ setup(
         "Operating System :: OS Independent",
         "Programming Language :: Python :: 3.7",
     ],
-    extra_require={
+    extras_require={
         "dev": ["unittest"],
+        "xlsx": ["openpyxl"],
     },
 )
@@ -1,4 +1,16 @@
-from metadata_registration_lib.es_utils import get_nb_pages
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from metadata_registration_lib import es_utils
+from metadata_registration_lib.es_utils import (
+    get_nb_pages,
+    get_bulk_lines,
+    iter_bulk_chunks,
+)
 
 
 def test_get_nb_pages():
@@ -7,3 +19,516 @@ def test_get_nb_pages():
     assert get_nb_pages(nb_hits=20, es_size=20) == 1
     assert get_nb_pages(nb_hits=20, es_size=21) == 1
     assert get_nb_pages(nb_hits=21, es_size=20) == 2
+
+
+def test_get_bulk_lines():
+    lines = get_bulk_lines("s1", "add", {"title": "Study"}).decode("utf-8")
+    assert lines.split("\n") == ['{"create": {"_id": "s1"}}', '{"title": "Study"}', ""]
+
+    lines = get_bulk_lines("s1", "delete").decode("utf-8")
+    assert lines == '{"delete": {"_id": "s1"}}\n'
+
+
+def test_iter_bulk_chunks():
+    bulk_lines = [get_bulk_lines(f"s{i}", "update", {"i": i}) for i in range(10)]
+
+    chunks = list(iter_bulk_chunks(bulk_lines, max_chunk_docs=4))
+    assert [chunk.count(b"\n") for chunk in chunks] == [8, 8, 4]
+    assert b"".join(chunks) == b"".join(bulk_lines)
+
+    doc_size = len(bulk_lines[0])
+    chunks = list(iter_bulk_chunks(bulk_lines, max_chunk_size=3 * doc_size))
+    assert all(len(chunk) <= 3 * doc_size for chunk in chunks)
+    assert b"".join(chunks) == b"".join(bulk_lines)
+
+
+def test_get_cv_tables_cache(monkeypatch):
+    calls = []
+
+    def fake_get_cv_items(cv_url, return_synonym_index=False):
+        calls.append(cv_url)
+        return {"species": {"human": "human - Homo sapiens"}}, {"species": {}}
+
+    monkeypatch.setattr(es_utils, "get_cv_items_expended_for_indexing", fake_get_cv_items)
+    monkeypatch.setattr(es_utils, "get_prop_name_to_cv_name", lambda url: {})
+    endpoints = {"cv": "http://api/cvs", "prop": "http://api/properties"}
+    es_utils.invalidate_cv_tables()
+
+    first = es_utils.get_cv_tables(endpoints)
+    second = es_utils.get_cv_tables(endpoints)
+    assert first is second
+    assert len(calls) == 1
+
+    es_utils.get_cv_tables(endpoints, ttl=0)
+    assert len(calls) == 2
+
+    es_utils.invalidate_cv_tables(endpoints)
+    es_utils.get_cv_tables(endpoints)
+    assert len(calls) == 3
+
+
+def test_expend_cv_values_with_synonym_index():
+    cv_items_expended = {
+        "species": {
+            "human": "human - Homo sapiens - hsa",
+            "mouse": "mouse - Mus musculus - mmu",
+        }
+    }
+    cv_synonym_index = {
+        "species": {
+            "human": "human",
+            "Homo sapiens": "human",
+            "hsa": "human",
+            "mouse": "mouse",
+            "Mus musculus": "mouse",
+            "mmu": "mouse",
+        }
+    }
+    study = {
+        "organism": "mmu",
+        "samples": [{"organism": ["Homo sapiens", "mouse"]}, {"organism": "Mus"}],
+    }
+
+    study = es_utils.expend_cv_values(
+        study, cv_items_expended, {"organism": "species"}, cv_synonym_index
+    )
+
+    assert study["organism"] == "mouse - Mus musculus - mmu"
+    assert study["samples"][0]["organism"] == (
+        "human - Homo sapiens - hsa // mouse - Mus musculus - mmu"
+    )
+    # Not an exact synonym: substring fallback
+    assert study["samples"][1]["organism"] == "mouse - Mus musculus - mmu"
+
+
+def test_cv_expansion_plan():
+    def field(prop_name, **kwargs):
+        return {"property": {"name": prop_name}, **kwargs}
+
+    study_form = {
+        "fields": [
+            field("title"),
+            field("organism"),
+            field(
+                "contact",
+                class_name="FormField",
+                fields=[field("name"), field("country")],
+            ),
+        ]
+    }
+    dataset_form = {
+        "fields": [
+            field(
+                "readouts",
+                class_name="FieldList",
+                args={"object": {"fields": [field("organism"), field("value")]}},
+            )
+        ]
+    }
+    prop_name_to_cv_name = {"organism": "species", "country": "countries"}
+
+    plan = es_utils.get_cv_expansion_plan(
+        {"": [study_form], "datasets": [dataset_form]}, prop_name_to_cv_name
+    )
+    assert plan == {
+        "organism": "species",
+        "contact": {"country": "countries"},
+        "datasets": {"readouts": {"organism": "species"}},
+    }
+
+    cv_items_expended = {
+        "species": {"human": "human - Homo sapiens"},
+        "countries": {"CH": "CH - Switzerland"},
+    }
+    study = {
+        "title": "human",
+        "organism": "human",
+        "contact": {"name": "CH", "country": "CH"},
+        "datasets": [{"readouts": [{"organism": ["human"], "value": "human"}]}],
+    }
+    study = es_utils.expend_cv_values_with_plan(study, plan, cv_items_expended)
+    assert study == {
+        "title": "human",
+        "organism": "human - Homo sapiens",
+        "contact": {"name": "CH", "country": "CH - Switzerland"},
+        "datasets": [
+            {"readouts": [{"organism": "human - Homo sapiens", "value": "human"}]}
+        ],
+    }
+
+
+def test_get_es_host_url():
+    es_config = {"HOST": "http://localhost", "PORT": 9200, "INDEX": "studies"}
+    assert es_utils.get_es_host_url(es_config) == "http://localhost:9200"
+    assert es_utils.get_es_index_url(es_config) == "http://localhost:9200/studies"
+
+
+def test_get_doc_diff():
+    previous_doc = {
+        "id": "s1",
+        "title": "Old title",
+        "contact": {"name": "A", "country": "CH"},
+        "samples": [{"sample_id": "S1"}],
+        "removed": "x",
+    }
+    new_doc = {
+        "id": "s1",
+        "title": "New title",
+        "contact": {"name": "A"},
+        "samples": [{"sample_id": "S1"}, {"sample_id": "S2"}],
+        "added": "y",
+    }
+    assert es_utils.get_doc_diff(previous_doc, new_doc) == {
+        "title": "New title",
+        "samples": [{"sample_id": "S1"}, {"sample_id": "S2"}],
+        "added": "y",
+    }
+    assert es_utils.get_removed_key_paths(previous_doc, new_doc) == [
+        ["contact", "country"],
+        ["removed"],
+    ]
+    assert es_utils.get_doc_diff(new_doc, new_doc) == {}
+
+
+def apply_partial_update(doc, body):
+    """Python version of a "doc" or PARTIAL_UPDATE_SCRIPT _update"""
+
+    def merge(target, changes):
+        for key, value in changes.items():
+            if isinstance(value, dict) and isinstance(target.get(key), dict):
+                merge(target[key], value)
+            else:
+                target[key] = value
+
+    params = body["script"]["params"] if "script" in body else {"doc": body["doc"]}
+    merge(doc, params["doc"])
+    for path in params.get("removed", []):
+        node = doc
+        for key in path[:-1]:
+            node = node.get(key) if isinstance(node, dict) else None
+        if isinstance(node, dict):
+            node.pop(path[-1], None)
+    return doc
+
+
+def test_partial_update_is_idempotent(monkeypatch):
+    cv_tables = {"cv_items_expended": {}, "prop_name_to_cv_name": {}}
+    indexed_doc = {"id": "s1", "a": None, "contact": {"name": "A", "country": "CH"}}
+    posted = []
+
+    class FakeRequests:
+        def post(self, url, data=None, headers=None, auth=None):
+            posted.append(json.loads(data))
+
+            class Response:
+                def json(self):
+                    return {"_id": "s1", "result": "updated"}
+
+            return Response()
+
+    monkeypatch.setattr(es_utils, "requests", FakeRequests())
+    for _ in range(2):
+        study = {
+            "id": "s1",
+            "entries": {"contact": {"name": "A"}},
+            "meta_information": {},
+        }
+        res = es_utils.index_study(
+            "url",
+            None,
+            study,
+            "partial_update",
+            None,
+            cv_tables=cv_tables,
+            previous_doc=indexed_doc,
+        )
+        if res["result"] != "noop":
+            apply_partial_update(indexed_doc, posted[-1])
+
+    assert len(posted) == 1
+    assert posted[0]["script"]["params"]["removed"] == [["a"], ["contact", "country"]]
+    assert indexed_doc == {"id": "s1", "contact": {"name": "A"}}
+    assert res["result"] == "noop"
+
+
+def test_bulk_index_studies_skips_unchanged(monkeypatch):
+    sent_ids = []
+
+    def fake_send_bulk_request(es_index_url, es_auth, body):
+        lines = body.decode("utf-8").splitlines()
+        ids = [json.loads(line)["index"]["_id"] for line in lines[::2]]
+        sent_ids.extend(ids)
+        return len(ids), []
+
+    monkeypatch.setattr(es_utils, "send_bulk_request", fake_send_bulk_request)
+    cv_tables = {"cv_items_expended": {}, "prop_name_to_cv_name": {}}
+
+    def get_studies(title_s2):
+        return [
+            {"id": "s1", "entries": {"title": "A"}, "meta_information": {}},
+            {"id": "s2", "entries": {"title": title_s2}, "meta_information": {}},
+        ]
+
+    manifest = {}
+    es_utils.bulk_index_studies(
+        "url", None, get_studies("B"), "update", None, cv_tables, manifest
+    )
+    assert sent_ids == ["s1", "s2"]
+    assert set(manifest.keys()) == {"s1", "s2"}
+
+    results = es_utils.bulk_index_studies(
+        "url", None, get_studies("B changed"), "update", None, cv_tables, manifest
+    )
+    assert sent_ids == ["s1", "s2", "s2"]
+    assert results["nb_skipped"] == 1
+
+
+def test_index_study_with_diff_drops_manifest_entry(monkeypatch):
+    posted = []
+
+    class FakeRequests:
+        def post(self, url, data=None, headers=None, auth=None):
+            posted.append((url, json.loads(data)))
+
+            class Response:
+                def json(self):
+                    return {"_id": "s1", "result": "updated"}
+
+            return Response()
+
+    monkeypatch.setattr(es_utils, "requests", FakeRequests())
+    cv_tables = {"cv_items_expended": {}, "prop_name_to_cv_name": {}}
+    manifest = {"s1": "old_hash", "s2": "other_hash"}
+
+    es_utils.index_study(
+        "url",
+        None,
+        {"id": "s1"},
+        "partial_update",
+        None,
+        cv_tables=cv_tables,
+        diff={"title": "New title"},
+        manifest=manifest,
+    )
+
+    assert posted == [("url/_update/s1", {"doc": {"title": "New title"}})]
+    assert manifest == {"s2": "other_hash"}
+
+
+def test_get_doc_hash():
+    assert es_utils.get_doc_hash({"a": 1, "b": [1, 2]}) == es_utils.get_doc_hash(
+        {"b": [1, 2], "a": 1}
+    )
+    assert es_utils.get_doc_hash({"a": 1}) != es_utils.get_doc_hash({"a": 2})
+
+
+class FakeESRequests:
+    """Fake requests module serving 5 hits with point in time support"""
+
+    def __init__(self):
+        self.deleted = []
+
+    def post(self, url, params=None, auth=None):
+        class Response:
+            status_code = 200
+
+            def json(self):
+                return {"id": "pit_1"}
+
+        return Response()
+
+    def delete(self, url, json=None, auth=None):
+        self.deleted.append((url, json))
+
+
+def test_iter_search_hits_with_pit(monkeypatch):
+    all_hits = [{"_id": f"s{i}", "sort": [i]} for i in range(5)]
+    search_bodies = []
+
+    def fake_send_es_request(method, url, es_auth, json_data=None):
+        search_bodies.append(dict(json_data))
+        start = json_data.get("search_after", [-1])[0] + 1
+        hits = all_hits[start : start + json_data["size"]]
+        return {"pit_id": "pit_2", "hits": {"hits": hits}}
+
+    fake_requests = FakeESRequests()
+    monkeypatch.setattr(es_utils, "requests", fake_requests)
+    monkeypatch.setattr(es_utils, "send_es_request", fake_send_es_request)
+
+    hits = list(
+        es_utils.iter_search_hits("http://es:9200/studies", None, page_size=2)
+    )
+
+    assert hits == all_hits
+    assert search_bodies[0]["pit"]["id"] == "pit_1"
+    assert search_bodies[1]["pit"]["id"] == "pit_2"
+    assert fake_requests.deleted == [("http://es:9200/_pit", {"id": "pit_2"})]
+
+
+def test_iter_prepared_studies():
+    cv_tables = {
+        "cv_items_expended": {"species": {"human": "human - Homo sapiens"}},
+        "prop_name_to_cv_name": {"organism": "species"},
+    }
+    studies = [
+        {"id": f"s{i}", "entries": {"organism": "human"}, "meta_information": {}}
+        for i in range(25)
+    ]
+
+    with es_utils.get_indexing_pool(cv_tables, processes=2) as executor:
+        docs = list(
+            es_utils.iter_prepared_studies(
+                studies, executor, batch_size=4, max_pending_batches=2
+            )
+        )
+
+    assert [doc["id"] for doc in docs] == [f"s{i}" for i in range(25)]
+    assert all(doc["organism"] == "human - Homo sapiens" for doc in docs)
+
+
+def test_reindex_studies_checkpoint(monkeypatch):
+    study_ids = ["s01", "s02", "s03", "s04", "s05"]
+    indexed_ids = []
+    fail_on = {"s03"}
+
+    def fake_fetch_studies(ids, study_url, concurrency, headers, params):
+        for id in ids:
+            yield id, {"id": id, "entries": {"title": id}, "meta_information": {}}
+
+    def fake_send_bulk_lines(es_index_url, es_auth, bulk_lines):
+        actions = [json.loads(lines.splitlines()[0]) for lines in bulk_lines]
+        ids = [action["index"]["_id"] for action in actions]
+        if fail_on & set(ids):
+            raise Exception("ES is down")
+        indexed_ids.extend(ids)
+        return {"nb_success": len(ids), "errors": []}
+
+    def fake_get_indexing_pool(cv_tables, processes=None):
+        return ThreadPoolExecutor(
+            initializer=es_utils.init_indexing_worker, initargs=(cv_tables,)
+        )
+
+    monkeypatch.setattr(
+        es_utils,
+        "map_key_value",
+        lambda url, key, value, mask: {id: id for id in study_ids},
+    )
+    monkeypatch.setattr(es_utils, "fetch_studies", fake_fetch_studies)
+    monkeypatch.setattr(es_utils, "send_bulk_lines", fake_send_bulk_lines)
+    monkeypatch.setattr(es_utils, "get_indexing_pool", fake_get_indexing_pool)
+    cv_tables = {"cv_items_expended": {}, "prop_name_to_cv_name": {}}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        checkpoint_path = os.path.join(tmp_dir, "checkpoint.json")
+        kwargs = {"cv_tables": cv_tables, "checkpoint_path": checkpoint_path}
+
+        with pytest.raises(Exception, match="ES is down"):
+            es_utils.reindex_studies(
+                "url", None, {"study": "api"}, page_size=2, **kwargs
+            )
+        assert indexed_ids == ["s01", "s02"]
+        assert es_utils.load_reindex_checkpoint(checkpoint_path)["last_id"] == "s02"
+
+        # Studies created or deleted before resuming do not shift the pages
+        study_ids[:] = ["s00", "s01", "s02", "s03", "s05", "s06"]
+        fail_on.clear()
+        results = es_utils.reindex_studies(
+            "url", None, {"study": "api"}, page_size=3, **kwargs
+        )
+
+        assert indexed_ids == ["s01", "s02", "s03", "s05", "s06"]
+        assert results["nb_success"] == 5
+        assert not os.path.exists(checkpoint_path)
+
+
+def run_reindex_with_alias(monkeypatch, old_indices, is_concrete_index):
+    calls = []
+    live_settings = {
+        "number_of_shards": "3",
+        "number_of_replicas": "2",
+        "refresh_interval": "30s",
+        "analysis": {"analyzer": {"folding": {"tokenizer": "standard"}}},
+        "uuid": "abc",
+    }
+
+    def fake_send_es_request(method, url, es_auth, json_data=None):
+        calls.append((method, url, json_data))
+        if url.endswith("/_settings") and method == "get":
+            return {old_indices[0]: {"settings": {"index": live_settings}}}
+        if url.endswith("/_mapping"):
+            return {old_indices[0]: {"mappings": {"properties": {"id": {}}}}}
+        return {"acknowledged": True}
+
+    monkeypatch.setattr(es_utils, "send_es_request", fake_send_es_request)
+    monkeypatch.setattr(
+        es_utils,
+        "get_alias_indices",
+        lambda es_host_url, es_auth, alias: (list(old_indices), is_concrete_index),
+    )
+    def fake_reindex_studies(es_index_url, es_auth, endpoints):
+        calls.append(("reindex", es_index_url))
+        return {"nb_success": 1, "nb_errors": 0, "errors": []}
+
+    monkeypatch.setattr(es_utils, "reindex_studies", fake_reindex_studies)
+    es_config = {"HOST": "http://es", "PORT": 9200, "INDEX": "studies"}
+
+    results = es_utils.reindex_studies_with_alias(es_config, None, new_index=None)
+    return results, calls
+
+
+def test_reindex_studies_with_alias(monkeypatch):
+    results, calls = run_reindex_with_alias(monkeypatch, ["studies_1"], False)
+    new_index = results["index"]
+    new_index_url = f"http://es:9200/{new_index}"
+
+    assert new_index.startswith("studies_")
+    assert [(method, url) for method, url, _ in calls[:3]] == [
+        ("get", "http://es:9200/studies_1/_settings"),
+        ("get", "http://es:9200/studies_1/_mapping"),
+        ("put", new_index_url),
+    ]
+    assert calls[2][2] == {
+        "settings": {
+            "index": {
+                "refresh_interval": "-1",
+                "number_of_replicas": 0,
+                "number_of_shards": "3",
+                "analysis": {"analyzer": {"folding": {"tokenizer": "standard"}}},
+            }
+        },
+        "mappings": {"properties": {"id": {}}},
+    }
+    assert calls[3] == ("reindex", new_index_url)
+    assert calls[4] == (
+        "put",
+        f"{new_index_url}/_settings",
+        {"index": {"refresh_interval": "30s", "number_of_replicas": 2}},
+    )
+    assert calls[5][:2] == ("post", f"{new_index_url}/_refresh")
+    assert calls[6] == (
+        "post",
+        "http://es:9200/_aliases",
+        {
+            "actions": [
+                {"add": {"index": new_index, "alias": "studies"}},
+                {"remove": {"index": "studies_1", "alias": "studies"}},
+            ]
+        },
+    )
+    assert calls[7][:2] == ("delete", "http://es:9200/studies_1")
+    assert len(calls) == 8
+
+
+def test_reindex_studies_with_alias_concrete_index(monkeypatch):
+    results, calls = run_reindex_with_alias(monkeypatch, ["studies"], True)
+
+    assert calls[-1] == (
+        "post",
+        "http://es:9200/_aliases",
+        {
+            "actions": [
+                {"add": {"index": results["index"], "alias": "studies"}},
+                {"remove_index": {"index": "studies"}},
+            ]
+        },
+    )
@@ -0,0 +1,204 @@
+import gzip
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from metadata_registration_lib.http_utils import (
+    DiskCache,
+    RequestScheduler,
+    cached_get,
+    encode_json_body,
+    iter_json_array,
+)
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeStreamResponse:
+    def __init__(self, content, encoding="utf-8"):
+        self.content = content.encode(encoding)
+        self.encoding = encoding
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i : i + chunk_size]
+
+
+class FakeCacheSession:
+    def __init__(self, body, etag):
+        self.body = body
+        self.etag = etag
+        self.requests_headers = []
+
+    def get(self, url, headers):
+        self.requests_headers.append(headers)
+        res = FakeResponse(200, headers={"ETag": self.etag})
+        if headers.get("If-None-Match") == self.etag:
+            res.status_code = 304
+        res.content = json.dumps(self.body).encode("utf-8")
+        res.json = lambda: self.body
+        return res
+
+
+class FakeSession:
+    def __init__(self, status_codes):
+        self.status_codes = list(status_codes)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        return FakeResponse(self.status_codes.pop(0))
+
+
+class TestRequestScheduler(unittest.TestCase):
+    def test_retry_on_throttling(self):
+        session = FakeSession([429, 503, 201])
+        scheduler = RequestScheduler(rate=1000, backoff_base=0.001, session=session)
+
+        res = scheduler.request("post", "http://api/studies")
+
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(session.calls, 3)
+
+    def test_give_up_after_max_retries(self):
+        session = FakeSession([503, 503, 503])
+        scheduler = RequestScheduler(
+            rate=1000, max_retries=2, backoff_base=0.001, session=session
+        )
+
+        res = scheduler.request("post", "http://api/studies")
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(session.calls, 3)
+
+    def test_post_not_retried_on_server_errors(self):
+        for method, expected_calls in [("post", 1), ("put", 3)]:
+            session = FakeSession([500, 500, 500])
+            scheduler = RequestScheduler(
+                rate=1000, max_retries=2, backoff_base=0.001, session=session
+            )
+
+            res = scheduler.request(method, "http://api/studies")
+
+            self.assertEqual(res.status_code, 500)
+            self.assertEqual(session.calls, expected_calls)
+
+    def test_concurrency_decreases_on_errors(self):
+        session = FakeSession([201, 201, 503, 201])
+        scheduler = RequestScheduler(
+            rate=1000, max_concurrency=8, backoff_base=0.001, session=session
+        )
+        scheduler.request("post", "http://api/studies")
+        scheduler.request("post", "http://api/studies")
+        limit_before_error = scheduler.concurrency.limit
+
+        scheduler.request("post", "http://api/studies")
+
+        self.assertLess(scheduler.concurrency.limit, limit_before_error)
+
+
+class TestEncodeJsonBody(unittest.TestCase):
+    def test_small_body_not_compressed(self):
+        body, headers = encode_json_body({"a": 1}, compress="gzip")
+
+        self.assertEqual(json.loads(body), {"a": 1})
+        self.assertNotIn("Content-Encoding", headers)
+
+    def test_large_body_compressed(self):
+        data = {"samples": [{"sample_id": f"S{i}", "organism": "human"} for i in range(2000)]}
+        body, headers = encode_json_body(data, compress="gzip")
+
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertLess(len(body), len(json.dumps(data)))
+        self.assertEqual(json.loads(gzip.decompress(body)), data)
+
+
+class TestIterJsonArray(unittest.TestCase):
+    def test_items_split_across_chunks(self):
+        data = [
+            {"name": "species", "items": [{"name": "homo_sapiens", "label": "Hömo"}]},
+            {"name": "tissue", "items": []},
+            12345,
+            "text, with [brackets]",
+        ]
+        for chunk_size in [1, 3, 7, 1024]:
+            res = FakeStreamResponse(json.dumps(data, ensure_ascii=False))
+            self.assertEqual(list(iter_json_array(res, chunk_size=chunk_size)), data)
+
+    def test_large_item_decoded_few_times(self):
+        data = [{"samples": [{"sample_id": f"S{i}"} for i in range(2000)]}, 1]
+        content = json.dumps(data)
+        with mock.patch.object(
+            json.JSONDecoder,
+            "raw_decode",
+            autospec=True,
+            side_effect=json.JSONDecoder.raw_decode,
+        ) as raw_decode:
+            items = list(iter_json_array(FakeStreamResponse(content), chunk_size=64))
+
+        self.assertEqual(items, data)
+        # One attempt per doubling of the buffer instead of one per chunk
+        self.assertLess(raw_decode.call_count, 20)
+        self.assertGreater(len(content) / 64, 500)
+
+    def test_empty_array(self):
+        self.assertEqual(list(iter_json_array(FakeStreamResponse(" [ ] "))), [])
+
+    def test_incomplete_array(self):
+        with self.assertRaises(Exception):
+            list(iter_json_array(FakeStreamResponse('[{"a": 1}, {"b"'), chunk_size=4))
+
+
+class TestDiskCache(unittest.TestCase):
+    def test_conditional_get(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = DiskCache(cache_dir)
+            session = FakeCacheSession({"id": "1", "title": "Study"}, etag='"v1"')
+
+            first = cached_get("http://api/studies/id/1", cache, session=session)
+            second = cached_get("http://api/studies/id/1", cache, session=session)
+
+            self.assertEqual(first, second)
+            self.assertNotIn("If-None-Match", session.requests_headers[0])
+            self.assertEqual(session.requests_headers[1]["If-None-Match"], '"v1"')
+
+    def test_mask_is_part_of_key(self):
+        self.assertNotEqual(
+            DiskCache.get_key("http://api/studies/id/1"),
+            DiskCache.get_key("http://api/studies/id/1", mask="id"),
+        )
+
+    def test_lru_eviction(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = DiskCache(cache_dir, max_size=25)
+            cache.set("a", b"0123456789", etag="a")
+            cache.set("b", b"0123456789", etag="b")
+            os.utime(cache._path("a", "meta"), (0, 0))
+            os.utime(cache._path("b", "meta"), (10, 10))
+            cache.touch("a")
+
+            cache.set("c", b"0123456789", etag="c")
+
+            self.assertIsNotNone(cache.get("a"))
+            self.assertIsNone(cache.get("b"))
+            self.assertIsNotNone(cache.get("c"))
+
+    def test_total_size_is_tracked_without_scanning(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = DiskCache(cache_dir, max_size=1000)
+            with mock.patch("os.listdir", wraps=os.listdir) as listdir:
+                for i in range(20):
+                    cache.set(f"k{i}", b"0123456789", etag=f"{i}")
+                cache.set("k0", b"01234", etag="0")
+                cache.delete("k1")
+
+                self.assertEqual(listdir.call_count, 1)
+
+            self.assertEqual(cache.get_total_size(), 20 * 10 - 5 - 10)
+            self.assertEqual(DiskCache(cache_dir).get_total_size(), 185)
@@ -1,6 +1,30 @@
+import contextlib
+import copy
+import io
 import unittest
+from collections import OrderedDict
 
-from metadata_registration_lib.sample_utils import StepTreatmentsInd, StepsSamples
+from dynamic_form import JsonFlaskParser
+from wtforms import BooleanField, Form, StringField
+from wtforms.validators import DataRequired
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+from metadata_registration_lib.sample_utils import (
+    StepReadouts,
+    StepTreatmentsInd,
+    StepsSamples,
+    SAMPLE_STEPS,
+    EntitySet,
+    FormValidator,
+    form_validation_plans,
+    get_step_entity_from_form_format,
+    unify_sample_entities_uuids,
+    validate_samples_with_form_validators,
+)
 
 
 class TestSimpleFunctions(unittest.TestCase):
@@ -28,4 +52,443 @@ class TestSimpleFunctions(unittest.TestCase):
         assert "uuid" in actual_output["T2"]
         del actual_output["T2"]["uuid"]
 
-        assert dict(actual_output) == expected_output
\ No newline at end of file
+        assert dict(actual_output) == expected_output
+
+    def test_unify_sample_entities_uuids(self):
+        individual = {"individual_id": "I1", "sex": "male", "uuid": "uuid_ind"}
+        existing_samples = [
+            {"sample_id": "S1", "tissue": ["blood"], "uuid": "uuid_s1"},
+            {"sample_id": "S2", "individual": individual, "uuid": "uuid_s2"},
+        ]
+        new_samples = [
+            # Identical to an existing sample
+            {"sample_id": "S1", "tissue": ["blood"]},
+            # New sample, same individual
+            {
+                "sample_id": "S3",
+                "individual": {"individual_id": "I1", "sex": "male"},
+                "uuid": "uuid_s3",
+            },
+            # Same new sample twice
+            {"sample_id": "S4"},
+            {"sample_id": "S4"},
+        ]
+
+        samples = unify_sample_entities_uuids(existing_samples, new_samples)
+
+        assert samples[0]["uuid"] == "uuid_s1"
+        assert samples[1]["uuid"] == "uuid_s3"
+        assert samples[1]["individual"]["uuid"] == "uuid_ind"
+        assert samples[2]["uuid"] == samples[3]["uuid"]
+
+    def test_get_step_entity_from_form_format(self):
+        sample = {
+            "sample_id": "S1",
+            "uuid": "uuid_s1",
+            "treatment": {"treatment_id": "T1"},
+            "individual": {
+                "individual_id": "I1",
+                "uuid": "uuid_ind",
+                "treatment": {"treatment_id": "T2"},
+            },
+        }
+        steps = {step.name: step for step in SAMPLE_STEPS}
+
+        bare_sample = get_step_entity_from_form_format(sample, "sample", steps["sample"])
+        bare_individual = get_step_entity_from_form_format(
+            sample, "sample", steps["individual"]
+        )
+        bare_treatment_ind = get_step_entity_from_form_format(
+            sample, "sample", steps["treatment_ind"]
+        )
+
+        assert bare_sample == {"sample_id": "S1", "uuid": "uuid_s1"}
+        assert bare_individual == {"individual_id": "I1", "uuid": "uuid_ind"}
+        assert bare_treatment_ind == {"treatment_id": "T2"}
+
+        # The input sample is not modified
+        bare_sample.pop("uuid")
+        bare_individual.pop("uuid")
+        assert sample["uuid"] == "uuid_s1"
+        assert sample["individual"]["uuid"] == "uuid_ind"
+        assert "treatment" in sample["individual"]
+
+    def test_check_entities_unicity_with_ids(self):
+        step = StepsSamples().individual
+        samples = [
+            {"sample_id": "S1", "individual": {"individual_id": "I1", "sex": "male"}},
+            {"sample_id": "S2", "individual": {"individual_id": "I1", "sex": "male"}},
+            {"sample_id": "S3", "individual": {"individual_id": "I1", "sex": "female"}},
+            {"sample_id": "S4", "individual": {"individual_id": "I1", "sex": "female"}},
+            {"sample_id": "S5", "individual": {"individual_id": "I2", "sex": "male"}},
+        ]
+        individuals = [sample["individual"] for sample in samples]
+
+        wrong_entities = step.check_entities_unicity_with_ids(individuals)
+
+        assert wrong_entities == [
+            {
+                "type": "individual",
+                "id": "I1",
+                "entities": [
+                    {"individual_id": "I1", "sex": "male"},
+                    {"individual_id": "I1", "sex": "female"},
+                ],
+            }
+        ]
+
+    def test_jexcel_data_with_nested_and_multiple_columns(self):
+        steps_sample = StepsSamples()
+        steps_sample.individual.entity_set.id_to_form_format = {
+            "I1": {"individual_id": "I1", "uuid": "uuid_ind"}
+        }
+        step = steps_sample.sample
+        step.entity_set.prop_names = [
+            "sample_id",
+            "individual",
+            "parent_sample_id",
+            "tissue",
+            "custom",
+        ]
+        step.entity_set.jexcel_data = [
+            ["S1", "I1", "P1; P2", "blood", "x"],
+            ["S2", "", "P3", "", ""],
+        ]
+
+        step.set_id_form_format_from_jexcel_data(
+            form_fields=["sample_id", "parent_sample_id", "tissue"],
+            sample_steps=steps_sample,
+        )
+        actual_output = step.entity_set.id_to_form_format
+        for entity in actual_output.values():
+            del entity["uuid"]
+
+        assert dict(actual_output) == {
+            "S1": {
+                "sample_id": "S1",
+                "individual": {"individual_id": "I1", "uuid": "uuid_ind"},
+                "parent_sample_id": ["P1", "P2"],
+                "tissue": "blood",
+                "user_defined_json_data": '{"custom": "x"}',
+            },
+            "S2": {"sample_id": "S2", "parent_sample_id": ["P3"]},
+        }
+
+    def test_readouts_jexcel_data_to_id_form_format(self):
+        step = StepReadouts()
+        step.entity_set.sample_set.id_to_form_format = {
+            "S1": {"sample_id": "S1", "uuid": "uuid_s1"},
+            "S2": {"sample_id": "S2", "uuid": "uuid_s2"},
+        }
+        step.entity_set.prop_names = ["readout_id", "samples", "file", "custom"]
+        step.entity_set.jexcel_data = [
+            ["R1", "S1;S2", "r1.fastq", ""],
+            ["R2", "S2", "r2.fastq", "x"],
+        ]
+
+        step.set_id_form_format_from_jexcel_data(form_fields=["readout_id", "file"])
+        actual_output = step.entity_set.id_to_form_format
+        for entity in actual_output.values():
+            del entity["uuid"]
+
+        assert dict(actual_output) == {
+            "R1": {
+                "readout_id": "R1",
+                "samples": ["uuid_s1", "uuid_s2"],
+                "file": "r1.fastq",
+            },
+            "R2": {
+                "readout_id": "R2",
+                "samples": ["uuid_s2"],
+                "file": "r2.fastq",
+                "user_defined_json_data": '{"custom": "x"}',
+            },
+        }
+
+        step.entity_set.jexcel_data = [["R3", "S1;S3", "r3.fastq", ""]]
+        with self.assertRaises(Exception):
+            step.set_id_form_format_from_jexcel_data(form_fields=["readout_id", "file"])
+
+    def test_readouts_columns_to_id_form_format(self):
+        class FakeArray:
+            def __init__(self, values):
+                self.values = values
+
+            def tolist(self):
+                return list(self.values)
+
+        step = StepReadouts()
+        step.entity_set.sample_set.id_to_form_format = {
+            "S1": {"sample_id": "S1", "uuid": "uuid_s1"},
+            "S2": {"sample_id": "S2", "uuid": "uuid_s2"},
+        }
+        # Stale sheet, replaced by the columns
+        step.entity_set.prop_names = ["readout_id"]
+        step.entity_set.jexcel_data = [["R0"]]
+        columns = {
+            "readout_id": FakeArray(["R1", "R2"]),
+            "samples": ("S1; S2", "S2"),
+            "file": ["r1.fastq", ""],
+            "custom": FakeArray(["", "x"]),
+        }
+
+        step.set_id_form_format_from_jexcel_data(
+            form_fields=["readout_id", "file"], columns=columns
+        )
+        actual_output = step.entity_set.id_to_form_format
+        for entity in actual_output.values():
+            del entity["uuid"]
+
+        assert step.entity_set.prop_names == ["readout_id", "samples", "file", "custom"]
+        assert step.entity_set.jexcel_data == []
+        assert dict(actual_output) == {
+            "R1": {
+                "readout_id": "R1",
+                "samples": ["uuid_s1", "uuid_s2"],
+                "file": "r1.fastq",
+            },
+            "R2": {
+                "readout_id": "R2",
+                "samples": ["uuid_s2"],
+                "user_defined_json_data": '{"custom": "x"}',
+            },
+        }
+
+        columns["file"] = ["r1.fastq"]
+        with self.assertRaises(Exception):
+            step.set_id_form_format_from_jexcel_data(
+                form_fields=["readout_id", "file"], columns=columns
+            )
+
+    def test_sheet_to_id_form_format(self):
+        steps_sample = StepsSamples()
+        steps_sample.individual.entity_set.id_to_form_format = {
+            "I1": {"individual_id": "I1", "uuid": "uuid_ind"}
+        }
+        step = steps_sample.sample
+        sheet = io.StringIO(
+            "sample_id,individual,parent_sample_id,custom\r\n"
+            "S1,I1,P1; P2,x\r\n"
+            ",,,\r\n"
+            "S2,,P3,\r\n"
+        )
+
+        step.set_id_form_format_from_sheet(
+            sheet,
+            form_fields=["sample_id", "parent_sample_id"],
+            batch_size=1,
+            sample_steps=steps_sample,
+        )
+        actual_output = step.entity_set.id_to_form_format
+        for entity in actual_output.values():
+            del entity["uuid"]
+
+        assert dict(actual_output) == {
+            "S1": {
+                "sample_id": "S1",
+                "individual": {"individual_id": "I1", "uuid": "uuid_ind"},
+                "parent_sample_id": ["P1", "P2"],
+                "user_defined_json_data": '{"custom": "x"}',
+            },
+            "S2": {"sample_id": "S2", "parent_sample_id": ["P3"]},
+        }
+
+    @unittest.skipIf(openpyxl is None, "openpyxl is not installed")
+    def test_xlsx_sheet_to_id_form_format(self):
+        workbook = openpyxl.Workbook()
+        # The active sheet is not the one holding the readouts
+        workbook.active.title = "Notes"
+        workbook.active.append(["comment"])
+        workbook.active.append(["Not a readout"])
+        worksheet = workbook.create_sheet("Readouts")
+        worksheet.append(["readout_id", "samples", "nb_reads"])
+        worksheet.append(["R1", "S1;S2", 1000])
+        worksheet.append([None, None, None])
+        worksheet.append(["R2", "S2", None])
+        sheet = io.BytesIO()
+        workbook.save(sheet)
+        sheet.seek(0)
+
+        step = StepReadouts()
+        step.entity_set.sample_set.id_to_form_format = {
+            "S1": {"sample_id": "S1", "uuid": "uuid_s1"},
+            "S2": {"sample_id": "S2", "uuid": "uuid_s2"},
+        }
+        step.set_id_form_format_from_sheet(
+            sheet,
+            form_fields=["readout_id", "nb_reads"],
+            file_format="xlsx",
+            sheet_name="Readouts",
+        )
+        actual_output = step.entity_set.id_to_form_format
+        for entity in actual_output.values():
+            del entity["uuid"]
+
+        assert dict(actual_output) == {
+            "R1": {
+                "readout_id": "R1",
+                "samples": ["uuid_s1", "uuid_s2"],
+                "nb_reads": "1000",
+            },
+            "R2": {"readout_id": "R2", "samples": ["uuid_s2"]},
+        }
+
+    def test_entity_set_validate_against_form(self):
+        class ReadoutForm(Form):
+            readout_id = StringField(validators=[DataRequired()])
+            paired = BooleanField()
+            comment = StringField()
+
+        entity_set = EntitySet(
+            id_to_form_format=OrderedDict(
+                [
+                    ("R1", {"readout_id": "R1", "paired": "true"}),
+                    ("R2", {"comment": "no id"}),
+                ]
+            )
+        )
+
+        validate_all, errors_html = entity_set.validate_against_form(ReadoutForm())
+
+        assert not validate_all
+        assert len(errors_html) == 1
+        assert "<b>R2</b>" in errors_html[0]
+        assert "readout_id" in errors_html[0]
+        assert entity_set.id_to_form_format["R1"]["paired"] is True
+        assert form_validation_plans[ReadoutForm].required_field_names == {
+            "readout_id"
+        }
+
+    def test_form_validator(self):
+        def field(prop_name, class_name, required=False, **kwargs):
+            validators = [{"class_name": "DataRequired"}] if required else []
+            return {
+                "class_name": class_name,
+                "property": {"name": prop_name, **kwargs},
+                "kwargs": {"validators": {"args": {"objects": validators}}},
+            }
+
+        organism_cv = {
+            "data_type": "ctrl_voc",
+            "controlled_vocabulary": {
+                "items": [{"name": "human", "label": "Human", "synonyms": []}]
+            },
+        }
+        form_json = {
+            "name": "sample",
+            "fields": [
+                field("sample_id", "StringField", required=True),
+                field("organism", "SelectField", value_type=organism_cv),
+                field("age", "IntegerField"),
+            ],
+        }
+        validator = FormValidator(form_json)
+
+        assert validator.validate({"sample_id": "S1", "organism": "human"}) == []
+        assert validator.validate({"organism": "cat", "age": "12"}) == [
+            ("sample_id", ["This field is required."]),
+            ("organism", ["Not a valid choice."]),
+        ]
+        assert validator.validate({"sample_id": " ", "age": "x"}) == [
+            ("sample_id", ["This field is required."]),
+            ("age", ["Not a valid integer value."]),
+        ]
+
+        samples = [
+            {"uuid": "u1", "sample_id": "S1", "individual": {"individual_id": "I1"}},
+            {"uuid": "u2", "sample_id": "S2", "organism": "cat"},
+        ]
+        validate_dict = {step.name: step.name == "sample" for step in SAMPLE_STEPS}
+        validate_all, errors = validate_samples_with_form_validators(
+            samples, validate_dict, {"sample": validator}
+        )
+
+        assert not validate_all
+        assert len(errors) == 1
+        assert errors[0].startswith("Sample u2 did not validate")
+
+    def test_jexcel_short_rows_ignore_missing_cells(self):
+        steps_sample = StepsSamples()
+        steps_sample.individual.entity_set.id_to_form_format = {
+            "I1": {"individual_id": "I1"}
+        }
+        step = steps_sample.sample
+        step.entity_set.prop_names = ["sample_id", "individual", "parent_sample_id"]
+        step.entity_set.jexcel_data = [["S1", "I1"], ["S2"]]
+
+        step.set_id_form_format_from_jexcel_data(
+            form_fields=["sample_id", "parent_sample_id"], sample_steps=steps_sample
+        )
+        actual_output = step.entity_set.id_to_form_format
+        for entity in actual_output.values():
+            del entity["uuid"]
+
+        assert dict(actual_output) == {
+            "S1": {"sample_id": "S1", "individual": {"individual_id": "I1"}},
+            "S2": {"sample_id": "S2"},
+        }
+
+        readout_step = StepReadouts()
+        readout_step.entity_set.prop_names = ["readout_id", "samples"]
+        readout_step.entity_set.jexcel_data = [["R1"]]
+        readout_step.set_id_form_format_from_jexcel_data(form_fields=["readout_id"])
+
+        assert list(readout_step.entity_set.id_to_form_format) == ["R1"]
+        assert "samples" not in readout_step.entity_set.id_to_form_format["R1"]
+
+    def test_form_validator_cross_check_with_wtforms(self):
+        def field(prop_name, class_name, validator_names=(), **kwargs):
+            validators = [{"class_name": name} for name in validator_names]
+            return {
+                "class_name": class_name,
+                "property": {
+                    "name": prop_name,
+                    "label": prop_name,
+                    "description": prop_name,
+                },
+                "kwargs": {"validators": {"args": {"objects": validators}}, **kwargs},
+            }
+
+        form_json = {
+            "name": "sample",
+            "fields": [
+                field("sample_id", "StringField", ["DataRequired"]),
+                field("batch", "StringField", ["InputRequired"]),
+                field(
+                    "organism",
+                    "SelectField",
+                    choices={"args": {"tuples": [["human", "Human"]]}},
+                ),
+                field("age", "IntegerField", ["Optional"]),
+                field("weight", "IntegerField"),
+            ],
+        }
+        validator = FormValidator(copy.deepcopy(form_json))
+        parser = JsonFlaskParser(form_type=Form)
+        form_class = parser.to_form(copy.deepcopy(form_json))[1]
+
+        samples = [
+            {"uuid": "u1", "sample_id": "S1", "organism": "human", "age": "x"},
+            {"uuid": "u2", "sample_id": "", "organism": "cat", "weight": "x"},
+        ]
+        validate_dict = {step.name: step.name == "sample" for step in SAMPLE_STEPS}
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            results = validate_samples_with_form_validators(
+                samples,
+                validate_dict,
+                {"sample": validator},
+                forms={"sample": form_class},
+            )
+
+        # InputRequired never validates with data (no raw input) and Optional always
+        # stops the validation, like in WTForms
+        assert output.getvalue() == ""
+        assert results == validate_samples_with_form_validators(
+            samples, validate_dict, {"sample": validator}
+        )
+        assert not results[0]
+        assert len(results[1]) == 2
+        assert "Field 'batch' did not validate" in results[1][0]
+        assert "age" not in results[1][0]
+        assert "Field 'weight' did not validate" in results[1][1]
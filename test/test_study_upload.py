@@ -0,0 +1,154 @@
+import threading
+import time
+
+import pytest
+
+from metadata_registration_lib import study_upload
+from metadata_registration_lib.http_utils import RequestScheduler
+
+
+class FakeSession:
+    """Fake pooled session serving studies, recording the max number of requests in flight"""
+
+    def __init__(self, headers, missing_ids=()):
+        self.headers = headers
+        self.missing_ids = set(missing_ids)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.urls = []
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def get(self, url):
+        with self.lock:
+            self.urls.append(url)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.005)
+        with self.lock:
+            self.in_flight -= 1
+
+        study_id = url.split("/id/")[1].split("?")[0]
+
+        class Response:
+            status_code = 404 if study_id in self.missing_ids else 200
+
+            def json(self):
+                if self.status_code == 404:
+                    return {"message": "Not found"}
+                return {"id": study_id}
+
+        return Response()
+
+
+def use_fake_session(monkeypatch, missing_ids=()):
+    sessions = []
+
+    def fake_get_pooled_session(pool_size, headers):
+        sessions.append(FakeSession(headers, missing_ids))
+        return sessions[-1]
+
+    monkeypatch.setattr(study_upload, "get_pooled_session", fake_get_pooled_session)
+    return sessions
+
+
+def test_fetch_studies(monkeypatch):
+    sessions = use_fake_session(monkeypatch)
+    ids = [f"s{i}" for i in range(50)]
+    nb_pulled = []
+
+    def iter_ids():
+        for i, study_id in enumerate(ids):
+            nb_pulled.append(i)
+            yield study_id
+
+    results = []
+    for study_id, study in study_upload.fetch_studies(
+        iter_ids(),
+        "http://api/studies",
+        mask="id, title",
+        concurrency=4,
+        headers={"Authorization": "token"},
+        params={"entry_format": "form"},
+    ):
+        # Ids are pulled lazily: at most 2 * concurrency requests are pending
+        assert len(nb_pulled) <= len(results) + 2 * 4
+        results.append((study_id, study))
+
+    session = sessions[0]
+    assert sorted(results) == sorted((i, {"id": i}) for i in ids)
+    assert session.headers == {"Authorization": "token", "X-Fields": "id, title"}
+    assert session.urls[0] == "http://api/studies/id/s0?entry_format=form"
+    assert 1 < session.max_in_flight <= 4
+
+
+def test_fetch_studies_error(monkeypatch):
+    use_fake_session(monkeypatch, missing_ids={"s3"})
+
+    with pytest.raises(Exception, match="study s3"):
+        list(study_upload.fetch_studies([f"s{i}" for i in range(6)], "http://api"))
+
+
+class FakeApiSession:
+    """Fake session answering the property GET and the entity POST"""
+
+    def __init__(self):
+        self.calls = []
+
+    def request(self, method, url, headers=None, data=None, stream=False):
+        self.calls.append((method, url))
+
+        class Response:
+            status_code = 200 if method == "get" else 201
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def json(self):
+                if method == "get":
+                    return [{"name": "title", "id": "p1"}]
+                return {"id": "s1"}
+
+        return Response()
+
+
+def test_upload_study_related_entity_scheduler():
+    session = FakeApiSession()
+    scheduler = RequestScheduler(rate=1000, session=session)
+
+    study_json, message, success = study_upload.upload_study_related_entity(
+        data={"entries": {"title": "My study"}},
+        url="http://api/studies",
+        method="post",
+        property_url="http://api/properties",
+        headers={},
+        scheduler=scheduler,
+    )
+
+    assert success
+    assert study_json == {"id": "s1"}
+    assert session.calls == [
+        ("get", "http://api/properties"),
+        ("post", "http://api/studies"),
+    ]
+
+    # A precomputed mapping skips the property GET
+    session.calls = []
+    study_upload.upload_study_related_entity(
+        data={"entries": {"title": "My study"}},
+        url="http://api/studies",
+        method="post",
+        property_url="http://api/properties",
+        headers={},
+        scheduler=scheduler,
+        prop_name_to_id={"title": "p1"},
+    )
+    assert session.calls == [("post", "http://api/studies")]